@@ -0,0 +1,408 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import argparse
+import shutil
+import random
+import re
+from collections import defaultdict
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+# Бенчмарки горячих путей бота на временной базе.
+# Запуск: python bench.py claim --sizes 10000 100000 1000000
+#         python bench.py plans  (код выхода 1, если горячий запрос ушел в полный скан)
+#         python bench.py phone --count 100000
+#         python bench.py afk --users 10000
+#         python bench.py race --procs 4 --taps 200  (код выхода 1, если переходы нарушили TRANSITIONS)
+#         python bench.py redis  (общее состояние процессов; без --url нужен pip install fakeredis lupa)
+
+TMP_DIR = tempfile.mkdtemp(prefix="bench_")
+os.environ.setdefault("BOT_TOKEN", "0:bench")
+os.environ["DB_NAME"] = os.path.join(TMP_DIR, "bench.db")
+
+import main  # noqa: E402
+
+TARIFFS = ("WhatsApp", "MAX")
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def ms(v):
+    return f"{v * 1000:8.3f}"
+
+async def fill_history(upto):
+    # История заливается одним INSERT ... SELECT, чтобы миллионы строк не шли через Python
+    async with main.get_db() as db:
+        have = (await (await db.execute("SELECT COUNT(*) FROM numbers")).fetchone())[0]
+        if upto > have:
+            await db.execute("""
+                WITH RECURSIVE seq(x) AS (SELECT ? UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                INSERT INTO numbers (user_id, phone, tariff_name, tariff_price, status, worker_id, start_time, end_time)
+                SELECT x % 5000, '+7' || (9000000000 + x), CASE x % 2 WHEN 0 THEN 'WhatsApp' ELSE 'MAX' END,
+                       '50₽', CASE x % 3 WHEN 0 THEN 'dead' ELSE 'finished' END, 1, ?, ?
+                FROM seq
+            """, (have + 1, upto, main.get_now(), main.get_now()))
+            await db.commit()
+
+async def fill_queue(n, start=0):
+    # Взятые номера остаются в 'work', поэтому каждый раунд берет свой диапазон телефонов
+    async with main.get_db() as db:
+        await db.executemany(
+            "INSERT INTO numbers (user_id, phone, tariff_name, tariff_price) VALUES (?, ?, ?, ?)",
+            [(i % 500, f"+7800{i:07d}", TARIFFS[i % 2], "50₽") for i in range(start, start + n)]
+        )
+        await db.commit()
+
+async def bench_claim(args):
+    print(f"{'rows':>10} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for r, size in enumerate(args.sizes):
+        await fill_history(size)
+        await fill_queue(args.claims, r * args.claims)
+        lat = []
+        for i in range(args.claims):
+            t0 = time.perf_counter()
+            async with main.get_db() as db:
+                row = await main.claim_number(db, TARIFFS[i % 2], 1, -100, 0)
+                await db.commit()
+            lat.append(time.perf_counter() - t0)
+            if not row: sys.exit("❌ claim вернул пустую очередь")
+        print(f"{size:>10} {ms(pct(lat, 0.5))} {ms(pct(lat, 0.99))} {ms(max(lat))}")
+
+async def bench_plans(args):
+    await fill_history(args.rows)
+    async with main.get_db() as db:
+        await db.execute("ANALYZE")
+        bad = await main.check_query_plans(db)
+    # Проверка самой проверки: без индекса по created_at отчет уходит в полный скан main.numbers.
+    # Отдельное соединение — у рабочего планы уже в кэше подготовленных запросов
+    pool = main.DBPool(main.DB_NAME, 0)
+    await pool.open()
+    async with pool.acquire() as db:
+        await db.execute("BEGIN")
+        await db.execute("DROP INDEX idx_numbers_created")
+        caught = [name for name, _ in await main.check_query_plans(db)]
+        await db.rollback()
+    await pool.close()
+    for name, detail in bad:
+        print(f"❌ {name}: {detail}")
+    if "fsm_rep" not in caught:
+        print(f"❌ без idx_numbers_created проверка не нашла скан fsm_rep: {caught}")
+        bad.append(("check", caught))
+    if bad: sys.exit(1)
+    print(f"✅ {len(main.HOT_QUERIES)} hot queries use indexes, a scan without idx_numbers_created is caught")
+
+def legacy_clean_phone(phone):
+    # Прежняя реализация main.clean_phone — эталон для сравнения
+    if not phone: return None
+    clean = re.sub(r'[^\d]', '', str(phone))
+    if clean.startswith('77') and len(clean) == 11: return '+' + clean
+    if clean.startswith('8') and len(clean) == 11: clean = '7' + clean[1:]
+    elif len(clean) == 10: clean = '7' + clean
+    return '+' + clean if re.match(r'^7\d{10}$', clean) else None
+
+def phone_samples(n):
+    rnd = random.Random(42)
+    shapes = ("+7 ({0}) {1}-{2}-{3}", "8{0}{1}{2}{3}", "7{0}{1}{2}{3}", "{0}{1}{2}{3}", "+7-{0}-{1}-{2}", "{0} {1}")
+    out = []
+    for _ in range(n):
+        d = f"{rnd.randrange(10**10):010d}"
+        out.append(rnd.choice(shapes).format(d[:3], d[3:6], d[6:8], d[8:]))
+    return out
+
+async def bench_phone(args):
+    samples = phone_samples(args.count)
+    bad = [s for s in samples if main.clean_phone(s) != legacy_clean_phone(s)]
+    if bad: sys.exit(f"❌ расхождение с прежним clean_phone: {bad[:5]}")
+    hot = samples[:args.hot] * (args.count // args.hot)
+
+    def timed(fn):
+        t0 = time.perf_counter()
+        fn()
+        return (time.perf_counter() - t0) / args.count * 1e9
+
+    rows = [
+        ("legacy, unique", timed(lambda: [legacy_clean_phone(s) for s in samples])),
+        ("normalize_many", timed(lambda: main.normalize_many(samples))),
+        ("legacy, repeated", timed(lambda: [legacy_clean_phone(s) for s in hot])),
+        ("clean_phone, repeated", timed(lambda: [main.clean_phone(s) for s in hot])),
+    ]
+    print(f"{'variant':<24} {'ns/phone':>9}")
+    for name, ns in rows:
+        print(f"{name:<24} {ns:9.0f}")
+
+class FakeBot:
+    # Bot API без сети: фиксированная задержка, доля юзеров заблокировала бота
+    def __init__(self, latency, blocked):
+        self.latency = latency
+        self.blocked = blocked
+        self.calls = 0
+
+    async def send_message(self, chat_id, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if chat_id % 100 < self.blocked * 100:
+            raise main.TelegramForbiddenError(method=None, message="bot was blocked by the user")
+
+async def bench_afk(args):
+    # Поставщики с очередью и просроченной проверкой: проходы с пингами, затем проход с киками
+    old = main.get_now() - 3600_000
+    async with main.get_db() as db:
+        await db.executemany(
+            "INSERT INTO users (user_id, is_approved, last_afk_check) VALUES (?, 1, ?)",
+            [(uid, old) for uid in range(1, args.users + 1)]
+        )
+        await db.executemany(
+            "INSERT INTO numbers (user_id, phone, tariff_name, tariff_price) VALUES (?, ?, ?, ?)",
+            [(uid, f"+7800{uid:07d}", TARIFFS[uid % 2], "50₽") for uid in range(1, args.users + 1)]
+        )
+        await db.commit()
+        await main.qindex.load(db)
+        await main.stats.reconcile(db)
+
+    bot = FakeBot(args.latency / 1000, args.blocked)
+    main.logger.setLevel("ERROR")
+    main.limiter.rate = main.limiter.tokens = 1e9
+    main.limiter.chat_interval = 0
+    main.outbox.start(bot)
+
+    print(f"{'sweep':<8} {'pinged':>7} {'kicked':>7} {'blocked':>7} {'seconds':>8}")
+    total = 0.0
+    while True:
+        t0 = time.perf_counter()
+        pinged, kicked, blocked = await main.afk_sweep()
+        dt = time.perf_counter() - t0
+        if not (pinged or blocked): break
+        total += dt
+        print(f"{'ping':<8} {pinged:>7} {kicked:>7} {blocked:>7} {dt:8.3f}")
+
+    async with main.get_db() as db:
+        await db.execute("UPDATE users SET afk_pending_since=? WHERE afk_pending_since IS NOT NULL", (old,))
+        await db.commit()
+    t0 = time.perf_counter()
+    pinged, kicked, blocked = await main.afk_sweep()
+    dt = time.perf_counter() - t0
+    total += dt
+    print(f"{'kick':<8} {pinged:>7} {kicked:>7} {blocked:>7} {dt:8.3f}")
+    print(f"{args.users} поставщиков: {total:.2f}s на все проходы, {bot.calls} вызовов API, "
+          f"в очереди осталось {main.qindex.queued()}")
+
+    # «Пропуск» возвращает номер единственного поставщика в очередь: проход ждет его по таймеру, а не по опросу
+    uid, worker = (args.users // 100 + 1) * 100 + 99, 777  # FakeBot не считает его заблокировавшим
+    async with main.get_db() as db:
+        await db.execute("INSERT INTO users (user_id, is_approved, last_afk_check) VALUES (?, 1, ?)", (uid, old))
+        nid = (await (await db.execute("""
+            INSERT INTO numbers (user_id, phone, tariff_name, tariff_price, status, worker_id)
+            VALUES (?, ?, ?, '50₽', 'work', ?) RETURNING id
+        """, (uid, f"+7800{uid:07d}", TARIFFS[0], worker))).fetchone())[0]
+        await db.commit()
+        await main.stats.reconcile(db)
+    main.timers.cancel("afk", 0)
+    c = SimpleNamespace(data=f"w_skip_{nid}", from_user=SimpleNamespace(id=worker),
+                        message=SimpleNamespace(edit_text=AsyncMock()), answer=AsyncMock())
+    await main.cb_w_skip(c, bot)
+    due = main.timers.deadlines.get(("afk", 0))
+    armed = bool(due) and due[0] <= time.time()
+    pinged = (await main.afk_sweep())[0] if armed else 0
+    print(f"после «Пропуска»: AFK-таймер {'взведен на просроченный срок' if armed else 'не взведен'}, пингов {pinged}")
+    await main.outbox.stop()
+    if not armed or pinged != 1: sys.exit(1)
+
+RACE_ACTIONS = ("activate", "activate", "skip", "drop", "error", "timeout")
+TERMINAL = ("finished", "dead")
+
+async def bench_race(args):
+    # Сотни одновременных нажатий по одним номерам из нескольких "процессов": у каждого свой пул и писатель.
+    # Примененные переходы должны складываться в путь по TRANSITIONS, а version — совпадать с их числом
+    now = main.get_now()
+    async with main.get_db() as db:
+        await db.executemany("""
+            INSERT INTO numbers (user_id, phone, tariff_name, tariff_price, status, worker_id, worker_chat_id, start_time, wait_code_start)
+            VALUES (?, ?, ?, ?, 'work', 1, -100, ?, ?)
+        """, [(i % 50, f"+7800{i:07d}", TARIFFS[i % 2], "50₽", now, now) for i in range(args.numbers)])
+        await db.commit()
+        ids = [r[0] for r in await (await db.execute("SELECT id FROM numbers ORDER BY id")).fetchall()]
+        await main.stats.reconcile(db)
+    pools = [main.DBPool(main.DB_NAME, 0) for _ in range(args.procs)]
+    for pool in pools: await pool.open()
+
+    async def tap(pool, nid, action):
+        async with pool.acquire() as db:
+            row = await (await db.execute("SELECT * FROM numbers WHERE id=?", (nid,))).fetchone()
+            if args.legacy:
+                # Прежние хендлеры: прочитать строку и записать статус без проверки
+                dst = main.TRANSITIONS[action][1]
+                new = await (await db.execute(
+                    "UPDATE numbers SET status=?, version=version+1 WHERE id=? RETURNING version", (dst, nid)
+                )).fetchone()
+                await main.stats.move(db, row['user_id'], row['tariff_name'], row['status'], dst, row['worker_chat_id'])
+            else:
+                guard = ("wait_code_start",) if action == "timeout" else ()
+                new = await main.transition(db, row, action, guard=guard)
+                if not new: return None
+            await db.commit()
+            return nid, new['version'], row['status'], action
+
+    rnd = random.Random(42)
+    jobs = [(pools[rnd.randrange(len(pools))], nid, rnd.choice(RACE_ACTIONS)) for nid in ids for _ in range(args.taps)]
+    rnd.shuffle(jobs)
+    t0 = time.perf_counter()
+    results = await asyncio.gather(*[tap(*j) for j in jobs])
+    dt = time.perf_counter() - t0
+
+    applied = defaultdict(list)
+    for res in filter(None, results): applied[res[0]].append(res[1:])
+    async with main.get_db() as db:
+        final = {r['id']: (r['status'], r['version']) for r in await (await db.execute("SELECT id, status, version FROM numbers")).fetchall()}
+        stats_clean = await main.stats.reconcile(db)
+    invalid = overwrites = version_gaps = 0
+    for nid in ids:
+        status = 'work'
+        for version, seen, action in sorted(applied[nid]):
+            src, dst = main.TRANSITIONS[action]
+            if seen != status or status not in src: invalid += 1
+            if status in TERMINAL: overwrites += 1
+            status = dst
+        if final[nid] != (status, len(applied[nid])): version_gaps += 1
+    for pool in pools: await pool.close()
+
+    n = sum(len(v) for v in applied.values())
+    print(f"{len(jobs)} нажатий из {args.procs} процессов по {len(ids)} номерам за {dt:.2f}s ({len(jobs) / dt:.0f}/s)")
+    print(f"применено {n} (уведомлений), отклонено {len(jobs) - n}, максимум на номер {max(map(len, applied.values()))}")
+    print(f"недопустимых переходов {invalid}, перезаписей финала {overwrites}, расхождений version {version_gaps}, "
+          f"счетчики {'сходятся' if stats_clean else 'расходятся'}")
+    if not args.legacy and (invalid or overwrites or version_gaps or not stats_clean): sys.exit(1)
+
+def redis_states(args, n):
+    # Несколько RedisState на одном сервере — как процессы бота; без --url сервер поддельный, в памяти
+    if main.Redis is None: sys.exit("pip install redis")
+    states = [main.RedisState(args.url or "redis://localhost") for _ in range(n)]
+    if not args.url:
+        try: import fakeredis
+        except ImportError: sys.exit("pip install fakeredis lupa")
+        server = fakeredis.FakeServer()
+        for st in states: st.redis = fakeredis.FakeAsyncRedis(server=server)
+    return states
+
+async def bench_redis(args):
+    # Два процесса на одном Redis: /num одного тарифа не идут параллельно, занятая очередь дает LockError,
+    # фоновая задача арендуется одним процессом и продлевается, FSM и лента изменений общие
+    from aiogram.fsm.storage.base import StorageKey
+    a, b = redis_states(args, 2)
+    failed = []
+    def check(name, ok, detail=""):
+        print(f"{'✅' if ok else '❌'} {name}{': ' + detail if detail else ''}")
+        if not ok: failed.append(name)
+
+    inside = overlaps = 0
+    async def claim(st):
+        nonlocal inside, overlaps
+        async with st.claim_lock("WhatsApp"):
+            inside += 1
+            if inside > 1: overlaps += 1
+            await asyncio.sleep(0.001)
+            inside -= 1
+    t0 = time.perf_counter()
+    await asyncio.gather(*[claim(st) for _ in range(args.claims) for st in (a, b)])
+    check("claim_lock", not overlaps, f"{2 * args.claims} захватов за {time.perf_counter() - t0:.2f}s, пересечений {overlaps}")
+
+    limit = main.CLAIM_LOCK_SECONDS
+    async with a.claim_lock("MAX"):
+        main.CLAIM_LOCK_SECONDS = 0.3
+        try:
+            async with b.claim_lock("MAX"): busy = False
+        except main.LockError: busy = True
+    check("claim_lock busy", busy, "второй процесс получает LockError после ожидания")
+    try:
+        async with a.claim_lock("MAX"): await asyncio.sleep(0.5)
+        expired = True
+    except main.LockError: expired = False
+    main.CLAIM_LOCK_SECONDS = limit
+    check("claim_lock ttl", expired, "истекшая блокировка отпускается без ошибки")
+
+    limit = main.LEASE_SECONDS
+    main.LEASE_SECONDS = 0.6
+    async with a.lease("afk") as got_a:
+        async with b.lease("afk") as got_b: pass
+        await asyncio.sleep(main.LEASE_SECONDS * 3)
+        async with b.lease("afk") as got_b_later: pass
+    async with b.lease("afk") as got_b_after: pass
+    main.LEASE_SECONDS = limit
+    check("lease", got_a and not got_b and not got_b_later and got_b_after,
+          f"a={got_a}, b={got_b}, b после 3 TTL={got_b_later}, b после освобождения={got_b_after}")
+
+    key = StorageKey(bot_id=1, chat_id=5, user_id=5)
+    await a.storage().set_state(key, "Form:phones")
+    await a.storage().set_data(key, {"tariff": "WhatsApp"})
+    state, data = await b.storage().get_state(key), await b.storage().get_data(key)
+    check("fsm", state == "Form:phones" and data == {"tariff": "WhatsApp"}, f"{state} {data}")
+
+    got = {a: [], b: []}
+    async def handler(st, kind): got[st].append(kind)
+    tasks = [asyncio.create_task(st.listen(lambda kind, st=st: handler(st, kind))) for st in (a, b)]
+    # Первая подписка ничего не перечитывает: ждем, пока оба процесса подпишутся
+    for _ in range(50):
+        if (await a.redis.pubsub_numsub(a.channel))[0][1] >= 2: break
+        await asyncio.sleep(0.02)
+    await a.publish("tariffs")
+    for _ in range(50):
+        if "tariffs" in got[b]: break
+        await asyncio.sleep(0.02)
+    for t in tasks: t.cancel()
+    check("pubsub", got[b] == ["tariffs"] and got[a] == [], f"a={got[a]}, b={got[b]}")
+
+    for st in (a, b): await st.close()
+    if failed: sys.exit(1)
+
+async def run(args):
+    await main.db_pool.open()
+    await main.init_db()
+    try:
+        await args.func(args)
+    finally:
+        await main.db_pool.close()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+def cli():
+    p = argparse.ArgumentParser(description="Бенчмарки ScarfaceTeamWa")
+    sub = p.add_subparsers(dest="cmd", required=True)
+
+    c = sub.add_parser("claim", help="латентность /num в зависимости от размера истории")
+    c.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    c.add_argument("--claims", type=int, default=500)
+    c.set_defaults(func=bench_claim)
+
+    c = sub.add_parser("plans", help="EXPLAIN QUERY PLAN для горячих запросов")
+    c.add_argument("--rows", type=int, default=100_000)
+    c.set_defaults(func=bench_plans)
+
+    c = sub.add_parser("phone", help="нормализация номеров против прежнего clean_phone")
+    c.add_argument("--count", type=int, default=100_000)
+    c.add_argument("--hot", type=int, default=500, help="сколько разных номеров в повторных запросах")
+    c.set_defaults(func=bench_phone)
+
+    c = sub.add_parser("afk", help="проход AFK-проверки по поставщикам с очередью")
+    c.add_argument("--users", type=int, default=10_000)
+    c.add_argument("--latency", type=float, default=5.0, help="задержка фейкового API, ms")
+    c.add_argument("--blocked", type=float, default=0.02, help="доля заблокировавших бота")
+    c.set_defaults(func=bench_afk)
+
+    c = sub.add_parser("race", help="параллельные переходы по одним номерам из нескольких процессов")
+    c.add_argument("--procs", type=int, default=4)
+    c.add_argument("--numbers", type=int, default=50)
+    c.add_argument("--taps", type=int, default=200, help="нажатий на каждый номер")
+    c.add_argument("--legacy", action="store_true", help="запись статуса без CAS, как в прежних хендлерах (с --procs 1: иначе упирается в блокировки SQLite)")
+    c.set_defaults(func=bench_race)
+
+    c = sub.add_parser("redis", help="общее состояние процессов в Redis: блокировки, аренды, FSM, pub/sub")
+    c.add_argument("--url", help="настоящий Redis вместо fakeredis")
+    c.add_argument("--claims", type=int, default=100, help="захватов claim_lock на процесс")
+    c.set_defaults(func=bench_redis)
+
+    asyncio.run(run(p.parse_args()))
+
+if __name__ == "__main__":
+    cli()
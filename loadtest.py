@@ -0,0 +1,295 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import random
+import argparse
+import shutil
+from collections import Counter, defaultdict
+
+# Нагрузочный прогон бота целиком офлайн: фейковый Bot API на localhost + синтетические апдейты через dp.feed_update.
+# Запуск: python loadtest.py --suppliers 5000 --topics 50 --latency 30 --rate429 0.01
+#         python loadtest.py --fail-p99 250  (код выхода 1, если p99 какого-то хендлера выше порога)
+
+TMP_DIR = tempfile.mkdtemp(prefix="loadtest_")
+ADMIN = 1
+os.environ["BOT_TOKEN"] = "123456:loadtest"
+os.environ["ADMIN_ID"] = str(ADMIN)
+os.environ["DB_NAME"] = os.path.join(TMP_DIR, "load.db")
+os.environ["METRICS_PORT"] = "0"
+os.environ.setdefault("SLOW_UPDATE_SECONDS", "5")
+os.environ.pop("REDIS_URL", None)
+
+import main  # noqa: E402
+from aiohttp import web  # noqa: E402
+from aiogram import Bot  # noqa: E402
+from aiogram.types import Update  # noqa: E402
+from aiogram.client.session.aiohttp import AiohttpSession  # noqa: E402
+from aiogram.client.telegram import TelegramAPIServer  # noqa: E402
+
+WORKER_BASE = 900_000
+SUPPLIER_BASE = 10_000
+GROUP_CHAT = -1001000000001
+MESSAGE_METHODS = ("sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageReplyMarkup")
+
+# ==========================================
+# ФЕЙКОВЫЙ BOT API
+# ==========================================
+
+class FakeBotAPI:
+    # Отвечает на любые методы: сообщения — объектом Message, copyMessage — MessageId, прочее — True.
+    # Задержка = latency ± jitter, доля ответов 429 задается rate429
+    def __init__(self, latency, jitter, rate429, retry_after):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate429 = rate429
+        self.retry_after = retry_after
+        self.calls = Counter()
+        self.throttled = Counter()
+        self.message_id = 0
+        self.rnd = random.Random(7)
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        data = await request.post()
+        delay = max(0.0, self.latency + self.rnd.uniform(-self.jitter, self.jitter))
+        if delay: await asyncio.sleep(delay)
+        self.calls[method] += 1
+
+        if self.rate429 and self.rnd.random() < self.rate429:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after}
+            }, status=429)
+        return web.json_response({"ok": True, "result": self.result(method, data)})
+
+    def result(self, method, data):
+        self.message_id += 1
+        if method == "copyMessage": return {"message_id": self.message_id}
+        if method == "getMe": return {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_bot"}
+        if method in MESSAGE_METHODS:
+            chat_id = int(data.get("chat_id") or 0)
+            return {
+                "message_id": self.message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "text": data.get("text", "")
+            }
+        return True
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        return runner
+
+# ==========================================
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# ==========================================
+
+class Driver:
+    def __init__(self, bot, dp, concurrency):
+        self.bot = bot
+        self.dp = dp
+        self.sem = asyncio.Semaphore(concurrency)
+        self.update_id = 0
+        self.message_id = 0
+        self.latency = defaultdict(list)
+        self.errors = Counter()
+        self.phases = []
+        self.commits = 0
+
+    async def record(self, handler, event, data):
+        # Внешний middleware внутри update_metrics: имя хендлера уже известно из PHASES
+        phases = main.PHASES.get()
+        t0 = time.perf_counter()
+        try: return await handler(event, data)
+        except Exception:
+            self.errors[phases["handler"]] += 1
+            raise
+        finally:
+            self.latency[phases["handler"]].append(time.perf_counter() - t0)
+
+    def chat(self, chat_id, thread=None):
+        if chat_id > 0: return {"id": chat_id, "type": "private", "first_name": "U"}
+        return {"id": chat_id, "type": "supergroup", "title": "Workers", "is_forum": True}
+
+    def message(self, uid, text, chat_id=None, thread=None):
+        self.message_id += 1
+        msg = {
+            "message_id": self.message_id, "date": int(time.time()),
+            "chat": self.chat(chat_id or uid), "from": {"id": uid, "is_bot": False, "first_name": "U", "username": f"u{uid}"},
+            "text": text
+        }
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        if thread:
+            msg["message_thread_id"] = thread
+            msg["is_topic_message"] = True
+        return {"message": msg}
+
+    def callback(self, uid, data, chat_id=None, thread=None):
+        body = self.message(uid, "🔘", chat_id, thread)["message"]
+        return {"callback_query": {
+            "id": str(self.update_id), "from": {"id": uid, "is_bot": False, "first_name": "U"},
+            "chat_instance": "load", "data": data, "message": body
+        }}
+
+    async def feed(self, payload):
+        self.update_id += 1
+        payload["update_id"] = self.update_id
+        update = Update.model_validate(payload, context={"bot": self.bot})
+        async with self.sem:
+            try: await self.dp.feed_update(self.bot, update)
+            except Exception: pass
+
+    async def sequence(self, payloads):
+        # Апдейты одного чата идут строго по очереди, как их отдал бы Telegram
+        for p in payloads:
+            await self.feed(p)
+
+    async def phase(self, name, sequences):
+        t0 = time.perf_counter()
+        await asyncio.gather(*[self.sequence(seq) for seq in sequences])
+        wall = time.perf_counter() - t0
+        count = sum(len(seq) for seq in sequences)
+        self.phases.append((name, count, wall))
+        print(f"  {name:<8} {count:>7} updates {wall:7.2f}s {count / wall if wall else 0:9.1f} upd/s", flush=True)
+
+# ==========================================
+# СЦЕНАРИЙ
+# ==========================================
+
+def fake_phone(i):
+    return f"+7{9000000000 + i}"
+
+async def scenario(d, args):
+    suppliers = [SUPPLIER_BASE + i for i in range(args.suppliers)]
+    topics = list(range(1, args.topics + 1))
+    tariffs = ("WhatsApp", "MAX")
+
+    await d.phase("start", [[d.message(uid, "/start")] for uid in suppliers])
+    await d.phase("approve", [[d.callback(ADMIN, f"acc_ok_{uid}") for uid in suppliers]])
+    await d.phase("upload", [[
+        d.message(uid, "/start"),
+        d.callback(uid, "sel_tariff"),
+        d.callback(uid, f"pick_{tariffs[i % 2]}"),
+        d.message(uid, "\n".join(fake_phone(i * args.numbers + k) for k in range(args.numbers))),
+    ] for i, uid in enumerate(suppliers)])
+    await d.phase("bind", [[
+        d.callback(ADMIN, f"bind_{tariffs[t % 2]}", GROUP_CHAT, t) for t in topics
+    ]])
+    # Шторм /num: все топики разом, в каждом воркер жмет подряд
+    await d.phase("num", [[
+        d.message(WORKER_BASE + t, "/num", GROUP_CHAT, t) for _ in range(args.claims)
+    ] for t in topics])
+
+    async with main.get_db(readonly=True) as db:
+        taken = await (await db.execute(
+            "SELECT id, user_id, phone, worker_id, worker_thread_id FROM numbers WHERE status='work'"
+        )).fetchall()
+    # Запрос кода воркером, ответ поставщика через мост, «Встал»
+    await d.phase("code", [[
+        d.message(r['worker_id'], f"/code {r['phone']}", GROUP_CHAT, r['worker_thread_id']),
+        d.message(r['user_id'], f"{random.randint(100000, 999999)}"),
+        d.callback(r['worker_id'], f"w_act_{r['id']}", GROUP_CHAT, r['worker_thread_id']),
+    ] for r in taken])
+    await d.phase("afk", [[d.callback(uid, f"afk_ok_{uid}")] for uid in suppliers])
+
+# ==========================================
+# ОТЧЕТ
+# ==========================================
+
+def pct(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def report(d, api, pool, outbox, args):
+    total = sum(n for _, n, _ in d.phases)
+    wall = sum(w for _, _, w in d.phases)
+    print(f"\nИтого: {total} апдейтов за {wall:.2f}s — {total / wall:.1f} upd/s")
+
+    print(f"\n{'handler':<20} {'count':>7} {'p50 ms':>8} {'p99 ms':>8} {'max ms':>8} {'errors':>6}")
+    worst = 0.0
+    for name, lat in sorted(d.latency.items(), key=lambda kv: -pct(kv[1], 0.99)):
+        p99 = pct(lat, 0.99) * 1000
+        worst = max(worst, p99)
+        print(f"{name:<20} {len(lat):>7} {pct(lat, 0.5) * 1000:8.2f} {p99:8.2f} {max(lat) * 1000:8.2f} {d.errors[name]:>6}")
+
+    print(f"\nSQLite: {pool['checkouts']} выдач соединений, {pool['waits']} ожиданий, "
+          f"среднее {pool['wait_avg_ms']} ms, максимум {pool['wait_max_ms']} ms, "
+          f"{d.commits} коммитов ({d.commits / wall:.1f}/s)")
+    wb = main.writes.stats()
+    print(f"Отложенная запись: {wb['puts']} записей → {wb['rows']} строк за {wb['commits']} коммитов")
+    print(f"Outbox: {outbox['sent']} отправлено, {outbox['retried']} повторов, "
+          f"{outbox['dropped']} сброшено, {outbox['pending']} не успели")
+    acc = main.access.stats()
+    print(f"Кэш доступа: {acc['hits']} попаданий, {acc['misses']} промахов, hit rate {acc['hit_rate']:.1%}")
+    print(f"Bot API: {sum(api.calls.values())} вызовов, 429: {sum(api.throttled.values())}")
+    for method, n in api.calls.most_common():
+        print(f"  {method:<24} {n:>7}  429: {api.throttled[method]}")
+
+    if args.fail_p99 and worst > args.fail_p99:
+        sys.exit(f"❌ p99 {worst:.1f} ms выше порога {args.fail_p99} ms")
+
+async def run(args):
+    api = FakeBotAPI(args.latency / 1000, args.jitter / 1000, args.rate429, args.retry_after)
+    api_runner = await api.start(args.port)
+
+    main.limiter.rate = args.tg_rate
+    main.limiter.tokens = args.tg_rate
+    await main.db_pool.open()
+    await main.init_db()
+    await main.load_state()
+
+    bot = Bot(main.TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(f"http://127.0.0.1:{args.port}")))
+    dp = main.build_dispatcher(bot)
+    d = Driver(bot, dp, args.concurrency)
+    dp.update.outer_middleware(d.record)
+    main.outbox.start(bot)
+    main.writes.start()
+
+    # Счетчик коммитов писателя: сколько fsync стоит сценарий
+    commit = main.db_pool.writer.commit
+    async def counted():
+        d.commits += 1
+        await commit()
+    main.db_pool.writer.commit = counted
+
+    print(f"▶ {args.suppliers} поставщиков × {args.numbers} номеров, {args.topics} топиков × {args.claims} /num, "
+          f"API {args.latency}±{args.jitter} ms, 429: {args.rate429:.1%}")
+    try:
+        await scenario(d, args)
+        pool = main.db_pool.stats()
+        await main.outbox.stop(args.drain)
+        await main.writes.stop()
+        report(d, api, pool, main.outbox.stats(), args)
+    finally:
+        await bot.session.close()
+        await main.db_pool.close()
+        await api_runner.cleanup()
+        shutil.rmtree(TMP_DIR, ignore_errors=True)
+
+def cli():
+    p = argparse.ArgumentParser(description="Офлайн нагрузочный тест ScarfaceTeamWa")
+    p.add_argument("--suppliers", type=int, default=5000)
+    p.add_argument("--numbers", type=int, default=3, help="номеров на поставщика")
+    p.add_argument("--topics", type=int, default=50)
+    p.add_argument("--claims", type=int, default=20, help="/num на топик")
+    p.add_argument("--concurrency", type=int, default=64, help="апдейтов в обработке одновременно")
+    p.add_argument("--latency", type=float, default=20, help="задержка фейкового API, ms")
+    p.add_argument("--jitter", type=float, default=10, help="разброс задержки, ms")
+    p.add_argument("--rate429", type=float, default=0.0, help="доля ответов 429")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--tg-rate", type=float, default=main.TG_GLOBAL_RATE, help="лимит outbox, сообщений/с")
+    p.add_argument("--drain", type=float, default=5, help="сколько секунд ждать outbox в конце")
+    p.add_argument("--port", type=int, default=8765)
+    p.add_argument("--fail-p99", type=float, default=0, help="порог p99 любого хендлера, ms")
+    asyncio.run(run(p.parse_args()))
+
+if __name__ == "__main__":
+    cli()
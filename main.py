@@ -5,7 +5,15 @@ import os
 import re
 import csv
 import io
-from datetime import datetime, timedelta, timezone
+import codecs
+import heapq
+import gzip
+import tempfile
+import time
+import bisect
+from contextvars import ContextVar
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+from functools import lru_cache
 from contextlib import asynccontextmanager
 
 try:
@@ -17,25 +25,94 @@ try:
     from aiogram.fsm.storage.memory import MemoryStorage
     from aiogram.types import (
         InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
-        Message, ReactionTypeEmoji, BufferedInputFile
+        Message, ReactionTypeEmoji, InputFile, Update
     )
     from aiogram.utils.keyboard import InlineKeyboardBuilder
-    from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest
+    from aiogram.exceptions import TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter
+    from aiohttp import web
 except ImportError:
     sys.exit("pip install aiogram aiosqlite")
 
+try:
+    from redis.asyncio import Redis
+    from redis.exceptions import LockError
+    from aiogram.fsm.storage.redis import RedisStorage
+except ImportError:
+    Redis = None
+    class LockError(Exception): pass
+
 # ==========================================
 # КОНФИГУРАЦИЯ
 # ==========================================
 
 TOKEN = os.getenv("BOT_TOKEN", "YOUR_TOKEN_HERE")
 ADMIN_ID = int(os.getenv("ADMIN_ID", "0"))
-DB_NAME = "fast_team_final.db"
+DB_NAME = os.getenv("DB_NAME", "fast_team_final.db")
+# С REDIS_URL состояние (FSM, привязки топиков, блокировки) общее для нескольких процессов
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "stw:")
+
+# Режим приема апдейтов: polling или webhook (aiohttp-сервер)
+RUN_MODE = os.getenv("RUN_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_CONNECTIONS = 40
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "16"))
+UPDATE_QUEUE = 500
+UPDATE_PUT_TIMEOUT = 10
+
+# Метрики Prometheus на локальном порту (0 — выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+SLOW_UPDATE_SECONDS = float(os.getenv("SLOW_UPDATE_SECONDS", "1.0"))
+
+# Кэш флагов доступа (одобрен/забанен)
+ACCESS_TTL = 60
+ACCESS_CACHE_SIZE = 20000
 
 # Таймеры
 AFK_CHECK_MINUTES = 8
 AFK_KICK_MINUTES = 3
 CODE_WAIT_MINUTES = 4
+QUEUE_RECONCILE_MINUTES = 10
+AFK_SWEEP_SECONDS = 15  # проходы AFK не чаще; сами проходы взводятся к ближайшему сроку
+AFK_SWEEP_BATCH = 2000
+
+# Лимиты Telegram Bot API и рассылка
+TG_GLOBAL_RATE = 30
+TG_CHAT_INTERVAL = 1.0
+BROADCAST_CONCURRENCY = 8
+BROADCAST_CHUNK = 200
+BROADCAST_PROGRESS_SECONDS = 3
+GROUP_STOP_LINES = 50
+QUEUE_PAGE_SIZE = 20
+OUTBOX_WORKERS = 8
+OUTBOX_MAX = 10000
+OUTBOX_RETRIES = 3
+CLAIM_LOCK_SECONDS = 10
+LEASE_SECONDS = 60
+
+# Импорт номеров
+IMPORT_CHUNK = 1000
+IMPORT_MAX_BYTES = 20 * 1024 * 1024
+
+# Нормализация номеров: "код_страны:длина_номера:транковые|префиксы" через запятую
+PHONE_RULES = os.getenv("PHONE_RULES", "7:10:8")
+PHONE_CACHE_SIZE = 4096
+
+# Архив: завершенные номера старше ARCHIVE_AFTER_DAYS переезжают в помесячные таблицы отдельного файла
+# (пустой ARCHIVE_DB или 0 дней — архив выключен)
+ARCHIVE_DB = os.getenv("ARCHIVE_DB", os.path.splitext(DB_NAME)[0] + "_archive.db")
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH = 2000
+ARCHIVE_INTERVAL_MINUTES = 60
+
+# Отчеты
+REPORT_CHUNK = 2000
+REPORT_SPOOL_BYTES = 8 * 1024 * 1024
 SEP = "━━━━━━━━━━━━━━━━━━━━"
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
@@ -45,17 +122,277 @@ router = Router()
 if not TOKEN or "YOUR_TOKEN" in TOKEN:
     sys.exit("❌ FATAL: BOT_TOKEN не указан!")
 
+# ==========================================
+# МЕТРИКИ
+# ==========================================
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Фазы текущего апдейта: сколько он провел в базе и в Bot API. Вне апдейта — None
+PHASES = ContextVar("phases", default=None)
+
+def phase_add(name, seconds):
+    phases = PHASES.get()
+    if phases is not None: phases[name] += seconds
+
+def label_value(v):
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metrics:
+    # Минимальный реестр в текстовом формате Prometheus: гистограммы, счетчики и гейджи-колбэки
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.help = {}
+        self.hists = defaultdict(dict)
+        self.counters = defaultdict(Counter)
+        self.gauges = {}
+
+    def describe(self, name, help_text):
+        self.help[name] = help_text
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        h = self.hists[name].get(key)
+        if not h: h = self.hists[name][key] = [[0] * (len(self.buckets) + 1), 0.0]
+        h[0][bisect.bisect_left(self.buckets, value)] += 1
+        h[1] += value
+
+    def inc(self, name, value=1, **labels):
+        self.counters[name][tuple(sorted(labels.items()))] += value
+
+    def gauge(self, name, help_text, fn):
+        # fn() -> {(("label", "value"), ...): число}
+        self.help[name] = help_text
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(key, extra=()):
+        pairs = [*key, *extra]
+        if not pairs: return ""
+        return "{" + ",".join(f'{k}="{label_value(v)}"' for k, v in pairs) + "}"
+
+    async def render(self):
+        out = []
+        for name, series in self.hists.items():
+            out += [f"# HELP {name} {self.help.get(name, name)}", f"# TYPE {name} histogram"]
+            for key, (counts, total) in series.items():
+                acc = 0
+                for le, n in zip((*self.buckets, "+Inf"), counts):
+                    acc += n
+                    out.append(f"{name}_bucket{self._labels(key, (('le', le),))} {acc}")
+                out.append(f"{name}_sum{self._labels(key)} {total}")
+                out.append(f"{name}_count{self._labels(key)} {acc}")
+        for name, series in self.counters.items():
+            out += [f"# HELP {name} {self.help.get(name, name)}", f"# TYPE {name} counter"]
+            out += [f"{name}{self._labels(key)} {v}" for key, v in series.items()]
+        for name, fn in self.gauges.items():
+            try:
+                series = fn()
+                if asyncio.iscoroutine(series): series = await series
+            except Exception as e:
+                logger.warning(f"⚠️ Gauge {name} failed: {e}")
+                continue
+            out += [f"# HELP {name} {self.help[name]}", f"# TYPE {name} gauge"]
+            out += [f"{name}{self._labels(key)} {v}" for key, v in series.items()]
+        return "\n".join(out) + "\n"
+
+metrics = Metrics(LATENCY_BUCKETS)
+metrics.describe("bot_update_seconds", "Update handling time by handler")
+metrics.describe("bot_update_db_seconds", "Time an update spent holding or waiting for DB connections")
+metrics.describe("bot_update_api_seconds", "Time an update spent in Bot API calls")
+metrics.describe("bot_update_errors_total", "Updates whose handler raised")
+metrics.describe("bot_api_seconds", "Bot API call latency by method")
+metrics.describe("bot_timer_seconds", "Deadline timer handler duration by kind")
+metrics.describe("bot_reconcile_seconds", "Queue index reconcile duration")
+metrics.describe("bot_afk_sweep_seconds", "AFK sweep duration")
+
+async def update_metrics(handler, event, data):
+    # Внешний middleware на апдейт: общее время и фазы; имя хендлера дописывает внутренний middleware
+    phases = {"db": 0.0, "api": 0.0, "handler": "unhandled"}
+    token = PHASES.set(phases)
+    t0 = time.perf_counter()
+    try: return await handler(event, data)
+    except Exception:
+        metrics.inc("bot_update_errors_total", handler=phases["handler"])
+        raise
+    finally:
+        PHASES.reset(token)
+        total = time.perf_counter() - t0
+        name = phases["handler"]
+        metrics.observe("bot_update_seconds", total, handler=name)
+        metrics.observe("bot_update_db_seconds", phases["db"], handler=name)
+        metrics.observe("bot_update_api_seconds", phases["api"], handler=name)
+        if total >= SLOW_UPDATE_SECONDS:
+            logger.warning(
+                f"🐢 Slow update {event.update_id} in {name}: {total:.3f}s "
+                f"(db {phases['db']:.3f}s, api {phases['api']:.3f}s, other {max(0.0, total - phases['db'] - phases['api']):.3f}s)"
+            )
+
+async def handler_name(handler, event, data):
+    phases = PHASES.get()
+    if phases is not None: phases["handler"] = data["handler"].callback.__name__
+    return await handler(event, data)
+
+async def api_metrics(make_request, bot, method):
+    t0 = time.perf_counter()
+    try: return await make_request(bot, method)
+    finally:
+        dt = time.perf_counter() - t0
+        metrics.observe("bot_api_seconds", dt, method=type(method).__name__)
+        phase_add("api", dt)
+
+def register_gauges():
+    # Гейджи считаются в момент запроса /metrics из того, что уже есть в памяти; базу читает только bot_numbers
+    metrics.gauge("bot_queue_numbers", "Numbers waiting in queue by tariff",
+                  lambda: {(("tariff", t),): n for t, n in qindex.by_tariff.items()})
+    metrics.gauge("bot_numbers", "Numbers by status", numbers_gauge)
+    metrics.gauge("bot_outbox", "Outbox state",
+                  lambda: {(("field", k),): v for k, v in outbox.stats().items()})
+    metrics.gauge("bot_db_pool", "DB pool state",
+                  lambda: {(("field", k),): float(v) for k, v in db_pool.stats().items()})
+    metrics.gauge("bot_access_cache", "Access flag cache",
+                  lambda: {(("field", k),): v for k, v in access.stats().items()})
+    metrics.gauge("bot_timers_armed", "Armed deadline timers",
+                  lambda: {(): len(timers.deadlines)})
+    metrics.gauge("bot_routes", "Live numbers in the bridge routing table",
+                  lambda: {(): len(routes.items)})
+    metrics.gauge("bot_write_behind", "Write-behind buffer state",
+                  lambda: {(("field", k),): v for k, v in writes.stats().items()})
+
+async def numbers_gauge():
+    # Единственный гейдж из базы: счетчики общие для всех процессов, чтение по первичному ключу
+    async with get_db(readonly=True) as db:
+        return {(("status", st),): n for st, n in (await stats.by_status(db)).items()}
+
+async def handle_metrics(request):
+    return web.Response(text=await metrics.render(), content_type="text/plain", charset="utf-8")
+
+async def handle_stats(request):
+    # Состояние пула вебхука — только на локальном порту метрик, не на публичном WEBHOOK_HOST
+    return web.json_response(update_pool.stats() if update_pool else {})
+
+async def start_metrics_server():
+    if not METRICS_PORT: return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/stats", handle_stats)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
 # ==========================================
 # БАЗА ДАННЫХ
 # ==========================================
 
-@asynccontextmanager
-async def get_db():
-    conn = await aiosqlite.connect(DB_NAME, timeout=30)
-    conn.row_factory = aiosqlite.Row
-    await conn.execute("PRAGMA journal_mode=WAL")
-    try: yield conn
-    finally: await conn.close()
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# FULL — коммит на диске до ответа (по умолчанию SQLite). NORMAL в WAL быстрее на каждом коммите,
+# но при отключении питания или падении ОС теряет последние коммиты (база при этом не портится)
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL").upper()
+if DB_SYNCHRONOUS not in ("FULL", "NORMAL", "EXTRA"): sys.exit("DB_SYNCHRONOUS: FULL, NORMAL или EXTRA")
+
+class DBPool:
+    # Один писатель + N читателей, PRAGMA выставляются один раз при открытии
+    def __init__(self, path, readers):
+        self.path = path
+        self.size = readers
+        self.writer = None
+        self.readers = asyncio.Queue()
+        self.wlock = asyncio.Lock()
+        self.held = {}
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def _connect(self, readonly=False):
+        conn = await aiosqlite.connect(self.path, timeout=30)
+        conn.row_factory = aiosqlite.Row
+        await conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+        await conn.execute("PRAGMA temp_store=MEMORY")
+        if ARCHIVE_DB: await conn.execute("ATTACH DATABASE ? AS archive", (ARCHIVE_DB,))
+        if readonly: await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        if self.writer: return
+        self.writer = await self._connect()
+        await (await self.writer.execute("PRAGMA journal_mode=WAL")).fetchall()
+        if ARCHIVE_DB: await (await self.writer.execute("PRAGMA archive.journal_mode=WAL")).fetchall()
+        for _ in range(self.size):
+            self.readers.put_nowait(await self._connect(readonly=True))
+        logger.info(f"🗄 DB pool opened: 1 writer + {self.size} readers")
+
+    async def close(self):
+        if not self.writer: return
+        stats = self.stats()
+        await self.writer.execute("PRAGMA optimize")
+        while not self.readers.empty():
+            await self.readers.get_nowait().close()
+        await self.writer.close()
+        self.writer = None
+        logger.info(f"🗄 DB pool closed: {stats}")
+
+    def _account(self, waited, t0):
+        dt = asyncio.get_running_loop().time() - t0
+        self.checkouts += 1
+        self.wait_total += dt
+        self.wait_max = max(self.wait_max, dt)
+        if waited: self.waits += 1
+
+    @asynccontextmanager
+    async def acquire(self, readonly=False):
+        task = asyncio.current_task()
+        # Вложенный get_db() в той же задаче получает уже выданное соединение
+        if task in self.held:
+            conn, is_writer = self.held[task]
+            if is_writer or readonly:
+                yield conn
+                return
+
+        t0 = asyncio.get_running_loop().time()
+        if readonly:
+            waited = self.readers.empty()
+            conn = await self.readers.get()
+            self._account(waited, t0)
+            self.held[task] = (conn, False)
+            try: yield conn
+            finally:
+                del self.held[task]
+                self.readers.put_nowait(conn)
+                phase_add("db", asyncio.get_running_loop().time() - t0)
+            return
+
+        outer = self.held.get(task)
+        waited = self.wlock.locked()
+        await self.wlock.acquire()
+        self._account(waited, t0)
+        self.held[task] = (self.writer, True)
+        try: yield self.writer
+        finally:
+            try:
+                if self.writer.in_transaction: await self.writer.rollback()
+            finally:
+                if outer: self.held[task] = outer
+                else: del self.held[task]
+                self.wlock.release()
+                if not outer: phase_add("db", asyncio.get_running_loop().time() - t0)
+
+    def stats(self):
+        return {
+            "checkouts": self.checkouts,
+            "waits": self.waits,
+            "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "readers_free": self.readers.qsize(),
+            "writer_busy": self.wlock.locked(),
+        }
+
+db_pool = DBPool(DB_NAME, DB_READERS)
+
+def get_db(readonly=False):
+    return db_pool.acquire(readonly)
 
 async def init_db():
     async with get_db() as db:
@@ -88,40 +425,1126 @@ async def init_db():
         await db.execute("INSERT OR IGNORE INTO tariffs VALUES('WhatsApp','50₽','10:00-22:00 МСК')")
         await db.execute("INSERT OR IGNORE INTO tariffs VALUES('MAX','10$','24/7')")
         await db.commit()
+
+        await migrate_db(db)
+        for name, detail in await check_query_plans(db):
+            logger.warning(f"⚠️ Full scan in hot query {name}: {detail}")
     logger.info("✅ Database initialized (FINAL MERGED)")
 
+# ==========================================
+# ОТЛОЖЕННАЯ ЗАПИСЬ
+# ==========================================
+
+WRITE_BEHIND_SECONDS = 0.3
+WRITE_BEHIND_MAX = 500
+
+# Идемпотентные UPDATE "значение по ключу": (SQL, durable). durable — вызывающий ждет коммита своей пачки
+WRITE_TYPES = {
+    "afk_seen": ("UPDATE users SET last_afk_check=?, afk_pending_since=NULL WHERE user_id=?", False),
+    "afk_ok": ("UPDATE users SET last_afk_check=?, afk_pending_since=NULL WHERE user_id=?", True),
+    "code_wait": ("UPDATE numbers SET wait_code_start=? WHERE id=?", False),
+}
+
+class WriteBehind:
+    # Частые мелкие записи копятся в памяти и уходят одной транзакцией раз в WRITE_BEHIND_SECONDS
+    # или при WRITE_BEHIND_MAX ключах. Повторная запись того же SQL по тому же ключу заменяет прежнюю.
+    # Кто читает эти колонки из базы для решений (таймаут кода, AFK-проход), сначала вызывает flush().
+    # then — корутина, которую надо запустить после коммита записи (например, оповестить соседние процессы)
+    def __init__(self):
+        self.pending = {}
+        self.waiters = []
+        self.after = []
+        self.full = asyncio.Event()
+        self.task = None
+        self.stopping = False
+        self.puts = 0
+        self.rows = 0
+        self.commits = 0
+
+    def start(self):
+        self.stopping = False
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # _run не отменяется: отмена посреди flush потеряла бы пачку, уже вынутую из pending
+        self.stopping = True
+        self.full.set()
+        if self.task: await self.task
+        await self.flush()
+        logger.info(f"🧾 Write-behind stopped: {self.stats()}")
+
+    async def put(self, kind, key, value, then=None):
+        sql, durable = WRITE_TYPES[kind]
+        self.pending[(sql, key)] = value
+        if then: self.after.append(then)
+        self.puts += 1
+        if len(self.pending) >= WRITE_BEHIND_MAX: self.full.set()
+        if not durable: return
+        fut = asyncio.get_running_loop().create_future()
+        self.waiters.append(fut)
+        await fut
+
+    async def _run(self):
+        while not self.stopping:
+            try: await asyncio.wait_for(self.full.wait(), WRITE_BEHIND_SECONDS)
+            except asyncio.TimeoutError: pass
+            try: await self.flush()
+            except Exception as e: logger.exception(f"Write-behind flush error: {e}")
+
+    async def flush(self):
+        self.full.clear()
+        if not self.pending: return
+        batch, self.pending = self.pending, {}
+        waiters, self.waiters = self.waiters, []
+        after, self.after = self.after, []
+        by_sql = defaultdict(list)
+        for (sql, key), value in batch.items(): by_sql[sql].append((value, key))
+        try:
+            async with get_db() as db:
+                for sql, rows in by_sql.items(): await db.executemany(sql, rows)
+                await db.commit()
+        except BaseException:
+            # Пачка возвращается в буфер (и при отмене задачи), более свежие значения не затираются
+            for k, v in batch.items(): self.pending.setdefault(k, v)
+            self.waiters += waiters
+            self.after[:0] = after
+            raise
+        self.rows += len(batch)
+        self.commits += 1
+        for fut in waiters:
+            if not fut.done(): fut.set_result(None)
+        for fn in after:
+            try: await fn()
+            except Exception as e: logger.warning(f"⚠️ Write-behind callback failed: {e}")
+
+    def stats(self):
+        return {"pending": len(self.pending), "puts": self.puts, "rows": self.rows, "commits": self.commits}
+
+writes = WriteBehind()
+
+# ==========================================
+# МИГРАЦИИ
+# ==========================================
+
+async def dedupe_live_phones(db):
+    # Перед уникальным индексом: лишние копии в очереди удаляются,
+    # из нескольких живых номеров в работе остается самый свежий
+    await db.execute("""
+        DELETE FROM numbers WHERE status='queue' AND EXISTS (
+            SELECT 1 FROM numbers o WHERE o.phone=numbers.phone AND o.id<>numbers.id
+              AND (o.status IN ('work','active') OR (o.status='queue' AND o.id<numbers.id))
+        )""")
+    await db.execute("""
+        UPDATE numbers SET status='dead', end_time=? WHERE status IN ('work','active') AND EXISTS (
+            SELECT 1 FROM numbers o WHERE o.phone=numbers.phone AND o.status IN ('work','active') AND o.id>numbers.id
+        )""", (get_now(),))
+
+# Текущий момент в мс от эпохи — для DEFAULT колонок
+EPOCH_MS_NOW = "(CAST(round((julianday('now') - 2440587.5) * 86400000) AS INTEGER))"
+
+def epoch_ms_sql(col):
+    # Прежние текстовые метки (CURRENT_TIMESTAMP без зоны, isoformat с +00:00) -> мс от эпохи; числа и NULL как есть
+    return (f"CASE WHEN {col} GLOB '[0-9][0-9][0-9][0-9]-*' "
+            f"THEN CAST(round((julianday({col}) - 2440587.5) * 86400000) AS INTEGER) ELSE CAST({col} AS INTEGER) END")
+
+NUMBERS_V6 = f"""CREATE TABLE {{t}} (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER, phone TEXT,
+    tariff_name TEXT, tariff_price TEXT, work_time TEXT,
+    status TEXT DEFAULT 'queue',
+    worker_id INTEGER DEFAULT 0, worker_chat_id INTEGER DEFAULT 0,
+    worker_thread_id INTEGER DEFAULT 0,
+    start_time INTEGER, end_time INTEGER, wait_code_start INTEGER,
+    created_at INTEGER DEFAULT {EPOCH_MS_NOW}
+)"""
+
+USERS_V6 = f"""CREATE TABLE {{t}} (
+    user_id INTEGER PRIMARY KEY, username TEXT, first_name TEXT,
+    is_approved INTEGER DEFAULT 0, is_banned INTEGER DEFAULT 0,
+    last_afk_check INTEGER, reg_date INTEGER DEFAULT {EPOCH_MS_NOW},
+    is_blocked INTEGER DEFAULT 0, afk_pending_since INTEGER
+)"""
+
+TS_COLUMNS = {
+    "numbers": ("start_time", "end_time", "wait_code_start", "created_at"),
+    "users": ("last_afk_check", "reg_date", "afk_pending_since"),
+}
+
+async def copy_converted(db, schema, src, dst, table):
+    # Общие колонки копируются, метки времени переводятся в мс
+    have = {r['name'] for r in await (await db.execute(f"PRAGMA {schema}.table_info({src})")).fetchall()}
+    cols = [r['name'] for r in await (await db.execute(f"PRAGMA main.table_info({table})")).fetchall() if r['name'] in have]
+    exprs = ", ".join(epoch_ms_sql(c) if c in TS_COLUMNS[table] else c for c in cols)
+    await db.execute(f"INSERT INTO {dst} ({', '.join(cols)}) SELECT {exprs} FROM {schema}.{src}")
+
+async def rebuild_table(db, table, ddl):
+    # Тип колонки в SQLite меняется только пересборкой: новая таблица, копия, подмена; индексы пересоздаются
+    indexes = [r[0] for r in await (await db.execute(
+        "SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL", (table,)
+    )).fetchall()]
+    seq = await (await db.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))).fetchone()
+    await db.execute(ddl.format(t=f"{table}_v6"))
+    await db.execute(f"ALTER TABLE {table} RENAME TO {table}_text")
+    await db.execute(f"ALTER TABLE {table}_v6 RENAME TO {table}")
+    await copy_converted(db, "main", f"{table}_text", table, table)
+    await db.execute(f"DROP TABLE {table}_text")
+    for sql in indexes: await db.execute(sql)
+    # Счетчик AUTOINCREMENT не откатывается ниже прежнего: id уехавших в архив номеров не выдаются повторно
+    if seq:
+        cur = await db.execute("UPDATE sqlite_sequence SET seq=max(seq, ?) WHERE name=?", (seq[0], table))
+        if not cur.rowcount: await db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)", (table, seq[0]))
+
+async def epoch_timestamps(db):
+    await rebuild_table(db, "numbers", NUMBERS_V6)
+    await rebuild_table(db, "users", USERS_V6)
+    if not ARCHIVE_DB: return
+    # Помесячные архивы пересобираются по новой схеме numbers
+    for (name,) in await (await db.execute(
+        "SELECT name FROM archive.sqlite_master WHERE type='table' AND name GLOB 'numbers_[0-9]*'"
+    )).fetchall():
+        await db.execute(f"DROP INDEX IF EXISTS archive.idx_{name}_created")
+        await db.execute(f"ALTER TABLE archive.{name} RENAME TO {name}_text")
+        table, _ = await archive._partition(db, name[len("numbers_"):])
+        await copy_converted(db, "archive", f"{name}_text", table, "numbers")
+        await db.execute(f"DROP TABLE archive.{name}_text")
+
+# (версия, шаги). Шаг — SQL-строка или async-функция от db.
+# Новые миграции только дописываются в конец, старые не редактируются.
+MIGRATIONS = [
+    (1, [
+        "CREATE INDEX IF NOT EXISTS idx_numbers_queue ON numbers(tariff_name, id) WHERE status='queue'",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_status ON numbers(status)",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_phone_status ON numbers(phone, status)",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_user_status ON numbers(user_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_worker_live ON numbers(worker_chat_id) WHERE status IN ('work','active')",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_wait_code ON numbers(wait_code_start) WHERE wait_code_start IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_created ON numbers(created_at)",
+    ]),
+    (2, [
+        "ALTER TABLE users ADD COLUMN is_blocked INTEGER DEFAULT 0",
+        "CREATE INDEX IF NOT EXISTS idx_users_audience ON users(user_id) WHERE is_approved=1 AND is_blocked=0",
+        """CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, from_chat_id INTEGER, message_id INTEGER,
+            status_chat_id INTEGER, status_message_id INTEGER,
+            state TEXT DEFAULT 'running', cursor INTEGER DEFAULT 0, total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0, failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP, finished_at TEXT
+        )""",
+    ]),
+    (3, [
+        dedupe_live_phones,
+        "CREATE UNIQUE INDEX IF NOT EXISTS ux_numbers_live_phone ON numbers(phone) WHERE status IN ('queue','work','active')",
+    ]),
+    (4, [
+        # Счетчики заполняет stats.reconcile при старте
+        """CREATE TABLE IF NOT EXISTS stats_counters (
+            scope TEXT NOT NULL, key TEXT NOT NULL, status TEXT NOT NULL, n INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (scope, key, status)
+        ) WITHOUT ROWID""",
+    ]),
+    (5, [
+        # Ожидание ответа на проверку — отдельная колонка вместо префикса PENDING_ в last_afk_check
+        "ALTER TABLE users ADD COLUMN afk_pending_since TEXT",
+        """UPDATE users SET afk_pending_since=substr(last_afk_check, 9), last_afk_check=substr(last_afk_check, 9)
+           WHERE last_afk_check LIKE 'PENDING\\_%' ESCAPE '\\'""",
+    ]),
+    (6, [
+        # Метки времени numbers/users (и архивов) — INTEGER, мс от эпохи
+        epoch_timestamps,
+    ]),
+    (7, [
+        # Фильтры браузера очереди по живым номерам: только строки в работе, индексы маленькие
+        "CREATE INDEX IF NOT EXISTS idx_numbers_live_worker ON numbers(worker_id, status) WHERE status IN ('work','active')",
+        "CREATE INDEX IF NOT EXISTS idx_numbers_live_tariff ON numbers(tariff_name, status) WHERE status IN ('work','active')",
+    ]),
+    (8, [
+        # Версия строки для CAS в transition(): растет при каждой смене статуса
+        "ALTER TABLE numbers ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
+
+async def get_schema_version(db):
+    row = await (await db.execute("SELECT value FROM config WHERE key='schema_version'")).fetchone()
+    return int(row['value']) if row else 0
+
+async def migrate_db(db):
+    current = await get_schema_version(db)
+    for version, steps in MIGRATIONS:
+        if version <= current: continue
+        # Каждая версия — одна транзакция: при ошибке база остается на предыдущей версии
+        await db.execute("BEGIN IMMEDIATE")
+        try:
+            for step in steps:
+                if callable(step): await step(db)
+                else: await db.execute(step)
+            await db.execute(
+                "INSERT OR REPLACE INTO config (key, value) VALUES ('schema_version', ?)", (str(version),)
+            )
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            logger.exception(f"❌ Migration {version} failed")
+            raise
+        logger.info(f"🧱 Schema migrated to v{version}")
+
+def queue_page_sql(status, tariff, worker, back):
+    # Keyset по id: страница — диапазон индекса от курсора, цена не зависит от глубины.
+    # Статус подставляется литералом (из QUEUE_VIEWS), иначе частичные индексы не подходят
+    where = [f"status='{status}'"]
+    if status != 'queue': where.append("status IN ('work','active')")
+    if tariff: where.append("tariff_name=?")
+    if worker: where.append("worker_id=?")
+    where.append("id<?" if back else "id>?")
+    table = "numbers INDEXED BY idx_numbers_queue" if status == 'queue' and tariff else "numbers"
+    return (f"SELECT id, user_id, phone, tariff_name, worker_id FROM {table} WHERE {' AND '.join(where)} "
+            f"ORDER BY id {'DESC' if back else 'ASC'} LIMIT ?")
+
+# Горячие запросы хендлеров: ни один не должен читать numbers полным сканом
+HOT_QUERIES = {
+    "cmd_num": ("SELECT id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue' AND tariff_name=? ORDER BY id ASC LIMIT 1", ("x",)),
+    "cb_my_nums": ("SELECT id, phone, status, tariff_price FROM numbers WHERE user_id=? AND status='queue' ORDER BY id ASC LIMIT 10", (0,)),
+    "queue_page": (queue_page_sql("queue", False, False, False), (0, 21)),
+    "queue_page_tariff": (queue_page_sql("queue", True, False, True), ("x", 0, 21)),
+    "live_page_tariff": (queue_page_sql("work", True, False, False), ("x", 0, 21)),
+    "live_page_worker": (queue_page_sql("active", False, True, True), (0, 0, 21)),
+    "cb_stop_g": ("SELECT id, user_id, phone, tariff_name, start_time FROM numbers WHERE status=? AND worker_chat_id=?", ("work", 0)),
+    "fsm_rep": ("SELECT id FROM main.numbers WHERE created_at >= ?", (0,)),
+    "monitor_code": ("SELECT id, wait_code_start FROM numbers WHERE status IN ('work','active') AND wait_code_start IS NOT NULL", ()),
+    "monitor_afk": ("SELECT user_id FROM users WHERE afk_pending_since < ? AND user_id IN (SELECT user_id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue')", (0,)),
+    "afk_next_due": ("""SELECT MIN(CASE WHEN afk_pending_since IS NULL THEN COALESCE(last_afk_check, 0) + ? ELSE afk_pending_since + ? END)
+        FROM users WHERE user_id IN (SELECT user_id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue')""", (0, 0)),
+}
+
+async def check_query_plans(db):
+    # Скан частичного индекса читает только живые строки и полным сканом не считается
+    partial = {r['name'] for r in await (await db.execute(
+        "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='numbers' AND sql LIKE '% WHERE %'"
+    )).fetchall()}
+    bad = []
+    for name, (sql, params) in HOT_QUERIES.items():
+        for row in await (await db.execute(f"EXPLAIN QUERY PLAN {sql}", params)).fetchall():
+            words = row['detail'].split()
+            # Таблица в плане бывает с именем схемы: "SCAN main.numbers"
+            if words[0] != "SCAN" or words[1].rsplit(".", 1)[-1] not in ("numbers", "n"): continue
+            if "INDEX" in words and words[-1] in partial: continue
+            bad.append((name, row['detail']))
+    return bad
+
+async def claim_number(db, tariff_name, worker_id, chat_id, thread_id, nid=None):
+    # Выбор и захват одним UPDATE: два одновременных /num не получат один номер.
+    # Переход "claim" из TRANSITIONS; строку выбирает сам UPDATE, поэтому guard — status='queue'
+    if nid:
+        return await (await db.execute("""
+            UPDATE numbers SET status='work', worker_id=?, worker_chat_id=?, worker_thread_id=?, start_time=?, version=version+1
+            WHERE id=? AND status='queue'
+            RETURNING *
+        """, (worker_id, chat_id, thread_id, get_now(), nid))).fetchone()
+    return await (await db.execute("""
+        UPDATE numbers SET status='work', worker_id=?, worker_chat_id=?, worker_thread_id=?, start_time=?, version=version+1
+        WHERE id=(SELECT id FROM numbers INDEXED BY idx_numbers_queue
+                  WHERE status='queue' AND tariff_name=? ORDER BY id ASC LIMIT 1)
+          AND status='queue'
+        RETURNING *
+    """, (worker_id, chat_id, thread_id, get_now(), tariff_name))).fetchone()
+
 # ==========================================
 # УТИЛИТЫ
 # ==========================================
 
+NON_DIGITS = re.compile(r'\D+')
+
+def build_phone_table(spec):
+    # Длина цифр -> [(префикс, сколько отрезать, код страны)]; порядок правил = приоритет
+    table = defaultdict(list)
+    for rule in filter(None, (r.strip() for r in spec.split(","))):
+        cc, national, *trunk = rule.split(":")
+        national = int(national)
+        table[len(cc) + national].append((cc, len(cc), cc))
+        for t in filter(None, (trunk[0] if trunk else "").split("|")):
+            table[len(t) + national].append((t, len(t), cc))
+        table[national].append(("", 0, cc))
+    return dict(table)
+
+PHONE_TABLE = build_phone_table(PHONE_RULES)
+
+def normalize_digits(digits, table=PHONE_TABLE):
+    for prefix, cut, cc in table.get(len(digits), ()):
+        if digits.startswith(prefix): return '+' + cc + digits[cut:]
+    return None
+
+@lru_cache(maxsize=PHONE_CACHE_SIZE)
+def _clean_phone(raw):
+    return normalize_digits(NON_DIGITS.sub('', raw))
+
 def clean_phone(phone):
+    # /code и /sms бьют по одним и тем же номерам — отдаем из кэша
     if not phone: return None
-    clean = re.sub(r'[^\d]', '', str(phone))
-    if clean.startswith('77') and len(clean) == 11: return '+' + clean
-    if clean.startswith('8') and len(clean) == 11: clean = '7' + clean[1:]
-    elif len(clean) == 10: clean = '7' + clean
-    return '+' + clean if re.match(r'^7\d{10}$', clean) else None
+    return _clean_phone(str(phone))
+
+def normalize_many(items):
+    # Пакетный путь для импорта: без кэша, чтобы тысячи уникальных номеров не вытесняли горячие
+    sub, table = NON_DIGITS.sub, PHONE_TABLE
+    return [normalize_digits(sub('', str(x)), table) if x else None for x in items]
 
 def mask_phone(phone, user_id):
     if user_id == ADMIN_ID: return phone
     try: return f"{phone[:5]}***{phone[-4:]}" if len(phone) > 9 else phone
     except: return phone
 
+MSK_OFFSET = 3 * 3600
+
 def get_now():
-    return datetime.now(timezone.utc).isoformat()
+    # Метки времени в базе — целые миллисекунды от эпохи (UTC): сравниваются как числа и идут по индексам
+    return time.time_ns() // 1_000_000
+
+@lru_cache(maxsize=4096)
+def _format_minute(minute):
+    return time.strftime("%Y-%m-%d %H:%M", time.gmtime(minute * 60 + MSK_OFFSET))
 
-def format_time(iso_str):
-    try: return (datetime.fromisoformat(iso_str) + timedelta(hours=3)).strftime("%Y-%m-%d %H:%M")
+def format_time(ms):
+    # В отчете у соседних строк одна и та же минута — форматирование берется из кэша
+    try: return _format_minute(ms // 60000) if ms else "-"
     except: return "-"
 
-def calc_duration(start_iso, end_iso):
-    try:
-        if not start_iso or not end_iso: return "0 мин"
-        s = datetime.fromisoformat(start_iso)
-        e = datetime.fromisoformat(end_iso)
-        mins = int((e - s).total_seconds() / 60)
-        return f"{mins} мин"
-    except: return "0 мин"
+def duration_minutes(start_ms, end_ms):
+    try: return (end_ms - start_ms) // 60000 if start_ms and end_ms else 0
+    except: return 0
+
+def calc_duration(start_ms, end_ms):
+    return f"{duration_minutes(start_ms, end_ms)} мин"
+
+# ==========================================
+# ОБЩЕЕ СОСТОЯНИЕ
+# ==========================================
+
+class LocalState:
+    # Один процесс: FSM в памяти, блокировки — asyncio.Lock, ленты изменений нет
+    def __init__(self):
+        self.locks = defaultdict(asyncio.Lock)
+
+    def storage(self):
+        return MemoryStorage()
+
+    async def publish(self, kind):
+        pass
+
+    async def listen(self, handler):
+        pass
+
+    @asynccontextmanager
+    async def claim_lock(self, tariff):
+        async with self.locks[tariff]:
+            yield
+
+    @asynccontextmanager
+    async def lease(self, name):
+        yield True
+
+    async def close(self):
+        pass
+
+class RedisState(LocalState):
+    # Несколько процессов: FSM в Redis, /num и долгие задачи под распределенными блокировками,
+    # изменения тарифов и привязок расходятся по процессам через pub/sub
+    def __init__(self, url):
+        super().__init__()
+        self.redis = Redis.from_url(url)
+        self.channel = f"{REDIS_PREFIX}config"
+        self.node = os.urandom(4).hex()
+
+    def storage(self):
+        return RedisStorage(redis=self.redis)
+
+    async def publish(self, kind):
+        await self.redis.publish(self.channel, f"{self.node}:{kind}")
+
+    async def listen(self, handler):
+        # Свои же сообщения пропускаем; после обрыва переподписываемся и перечитываем все —
+        # за время разрыва могли пропустить изменения. Первая подписка идет сразу после load_state, ее не перечитываем
+        lost = False
+        while True:
+            try:
+                async with self.redis.pubsub() as ps:
+                    await ps.subscribe(self.channel)
+                    if lost: await handler("all")
+                    async for msg in ps.listen():
+                        if msg["type"] != "message": continue
+                        node, kind = msg["data"].decode().split(":", 1)
+                        if node != self.node: await handler(kind)
+            except asyncio.CancelledError: raise
+            except Exception as e:
+                lost = True
+                logger.warning(f"⚠️ Config feed lost: {e}, resubscribing")
+                await asyncio.sleep(5)
+
+    @asynccontextmanager
+    async def claim_lock(self, tariff):
+        # Локальный Lock впереди, чтобы корутины одного процесса не долбили Redis по очереди
+        async with self.locks[tariff]:
+            lock = self.redis.lock(f"{REDIS_PREFIX}claim:{tariff}", timeout=CLAIM_LOCK_SECONDS, blocking_timeout=CLAIM_LOCK_SECONDS)
+            if not await lock.acquire(): raise LockError(f"claim:{tariff} busy")
+            try: yield
+            finally:
+                # Блокировка могла истечь по TTL посреди транзакции: выдача уже закоммичена, ошибку не пробрасываем
+                try: await lock.release()
+                except LockError: pass
+
+    @asynccontextmanager
+    async def lease(self, name):
+        # Аренда долгой задачи: продлевается, пока задача жива; упавший процесс отпустит ее по TTL
+        lock = self.redis.lock(f"{REDIS_PREFIX}lease:{name}", timeout=LEASE_SECONDS)
+        if not await lock.acquire(blocking=False):
+            yield False
+            return
+
+        async def keep():
+            while True:
+                await asyncio.sleep(LEASE_SECONDS / 3)
+                await lock.reacquire()
+
+        task = asyncio.create_task(keep())
+        try: yield True
+        finally:
+            task.cancel()
+            try: await lock.release()
+            except LockError: pass
+
+    async def close(self):
+        await self.redis.aclose()
+
+def make_shared_state():
+    if not REDIS_URL: return LocalState()
+    if Redis is None: sys.exit("pip install redis")
+    return RedisState(REDIS_URL)
+
+shared = make_shared_state()
+
+# ==========================================
+# КЭШ КОНФИГУРАЦИИ
+# ==========================================
+
+Tariff = namedtuple("Tariff", "name price work_time")
+
+class ConfigCache:
+    # Тарифы и привязки топиков в памяти: читаются при старте, меняются только через методы ниже.
+    # Клавиатуры с тарифами собираются вместе с данными и переиспользуются
+    def __init__(self):
+        self.tariffs = {}
+        self.bindings = {}
+        self.keyboards = {}
+
+    async def load(self, kind="all"):
+        async with get_db(readonly=True) as db:
+            if kind in ("all", "tariffs"):
+                rows = await (await db.execute("SELECT name, price, work_time FROM tariffs ORDER BY rowid")).fetchall()
+                self.tariffs = {r['name']: Tariff(*r) for r in rows}
+                self.keyboards = self._build_keyboards()
+            if kind in ("all", "bindings"):
+                rows = await (await db.execute("SELECT key, value FROM config WHERE key LIKE 'topic\\_%' ESCAPE '\\'")).fetchall()
+                self.bindings = {}
+                for r in rows:
+                    _, chat_id, thread_id = r['key'].rsplit("_", 2)
+                    self.bindings[(int(chat_id), int(thread_id))] = r['value']
+
+    def _build_keyboards(self):
+        pick = InlineKeyboardBuilder()
+        bind = InlineKeyboardBuilder()
+        edit = InlineKeyboardBuilder()
+        for t in self.tariffs.values():
+            pick.button(text=f"{t.name} | {t.price}", callback_data=f"pick_{t.name}")
+            bind.button(text=t.name, callback_data=f"bind_{t.name}")
+            edit.button(text=f"✏️ {t.name}", callback_data=f"ed_{t.name}")
+        pick.button(text="🔙 Меню", callback_data="back_main")
+        edit.button(text="🔙 Назад", callback_data="admin_main")
+        for kb in (pick, bind, edit): kb.adjust(1)
+        return {"pick": pick.as_markup(), "bind": bind.as_markup(), "edit": edit.as_markup()}
+
+    def tariff(self, name):
+        return self.tariffs.get(name)
+
+    def binding(self, chat_id, thread_id):
+        return self.bindings.get((chat_id, thread_id))
+
+    async def set_binding(self, chat_id, thread_id, tariff):
+        async with get_db() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
+                (f"topic_{chat_id}_{thread_id}", tariff)
+            )
+            await db.commit()
+        self.bindings[(chat_id, thread_id)] = tariff
+        await shared.publish("bindings")
+
+    async def update_tariff(self, name, price, work_time):
+        async with get_db() as db:
+            await db.execute("UPDATE tariffs SET price=?, work_time=? WHERE name=?", (price, work_time, name))
+            await db.commit()
+        await self.load("tariffs")
+        await shared.publish("tariffs")
+
+    async def on_change(self, kind):
+        await self.load(kind)
+        logger.info(f"🔄 Config reloaded: {kind}")
+
+config = ConfigCache()
+
+# ==========================================
+# ОТПРАВКА В TELEGRAM
+# ==========================================
+
+class RateLimiter:
+    # Token bucket на весь бот + минимальный интервал между сообщениями в один чат.
+    # После TelegramRetryAfter вся отправка ставится на паузу через pause().
+    def __init__(self, rate, chat_interval):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.chat_interval = chat_interval
+        self.chat_next = {}
+        self.paused_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, chat_id=None):
+        if chat_id is not None:
+            now = time.monotonic()
+            slot = self.chat_next.get(chat_id, 0.0)
+            self.chat_next[chat_id] = max(now, slot) + self.chat_interval
+            if len(self.chat_next) > 10000:
+                self.chat_next = {k: v for k, v in self.chat_next.items() if v > now}
+            if slot > now: await asyncio.sleep(slot - now)
+
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.paused_until > now:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+limiter = RateLimiter(TG_GLOBAL_RATE, TG_CHAT_INTERVAL)
+
+# Линии приоритета: мост юзер↔воркер и запросы кода идут раньше уведомлений
+PRIO_BRIDGE = 0
+PRIO_NOTIFY = 1
+
+class Outbox:
+    # Хендлеры ставят сообщение в очередь и не ждут отправки.
+    # У каждого чата своя FIFO-очередь: чат стоит в линии приоритета своего первого сообщения
+    # и обрабатывается одним воркером за раз, поэтому порядок внутри чата сохраняется.
+    def __init__(self, limiter, workers):
+        self.limiter = limiter
+        self.size = workers
+        self.bot = None
+        self.lanes = (deque(), deque())
+        self.chats = {}
+        self.ready = asyncio.Event()
+        self.tasks = []
+        self.pending = 0
+        self.sent = 0
+        self.retried = 0
+        self.dropped = 0
+
+    def start(self, bot):
+        self.bot = bot
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.size)]
+
+    async def stop(self, timeout=5):
+        # Даем дослать накопленное, потом гасим воркеров
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for t in self.tasks: t.cancel()
+        logger.info(f"📤 Outbox stopped: {self.stats()}")
+
+    def send(self, chat_id, text=None, prio=PRIO_NOTIFY, method="send_message", on_ok=None, on_fail=None, **kwargs):
+        fut = asyncio.get_running_loop().create_future()
+        # Исключение могут не забрать: помечаем его прочитанным, чтобы asyncio не ругался
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if text is not None: kwargs['text'] = text
+        kwargs['chat_id'] = chat_id
+
+        if self.pending >= OUTBOX_MAX and prio != PRIO_BRIDGE:
+            self.dropped += 1
+            fut.set_exception(RuntimeError("outbox overflow"))
+            if on_fail: asyncio.create_task(self._call(on_fail))
+            return fut
+
+        self.pending += 1
+        if chat_id not in self.chats:
+            self.chats[chat_id] = deque()
+            self.lanes[prio].append(chat_id)
+            self.ready.set()
+        self.chats[chat_id].append((prio, method, kwargs, fut, on_ok, on_fail))
+        return fut
+
+    def _next_chat(self):
+        for lane in self.lanes:
+            if lane: return lane.popleft()
+        return None
+
+    async def _worker(self):
+        while True:
+            chat_id = self._next_chat()
+            if chat_id is None:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            items = self.chats[chat_id]
+            await self._deliver(chat_id, items.popleft())
+            self.pending -= 1
+            if items: self.lanes[items[0][0]].append(chat_id)
+            else: del self.chats[chat_id]
+
+    async def _deliver(self, chat_id, item):
+        prio, method, kwargs, fut, on_ok, on_fail = item
+        error = None
+        for attempt in range(OUTBOX_RETRIES + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                result = await getattr(self.bot, method)(**kwargs)
+                self.sent += 1
+                if not fut.done(): fut.set_result(result)
+                if on_ok: await self._call(on_ok)
+                return
+            except TelegramRetryAfter as e:
+                self.retried += 1
+                self.limiter.pause(e.retry_after)
+                error = e
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                error = e
+                break
+            except Exception as e:
+                # Сеть/5xx: короткая пауза с ростом
+                self.retried += 1
+                error = e
+                await asyncio.sleep(2 ** attempt)
+        self.dropped += 1
+        logger.warning(f"Outbox drop {method} -> {chat_id}: {error}")
+        if not fut.done(): fut.set_exception(error)
+        if on_fail: await self._call(on_fail)
+
+    async def _call(self, cb):
+        try: await cb()
+        except Exception as e: logger.error(f"Outbox callback error: {e}")
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "bridge_chats": len(self.lanes[PRIO_BRIDGE]),
+            "notify_chats": len(self.lanes[PRIO_NOTIFY]),
+            "sent": self.sent,
+            "retried": self.retried,
+            "dropped": self.dropped,
+        }
+
+outbox = Outbox(limiter, OUTBOX_WORKERS)
+
+# ==========================================
+# ОЧЕРЕДЬ В ПАМЯТИ
+# ==========================================
+
+QueueItem = namedtuple("QueueItem", "id user_id phone tariff_name tariff_price")
+
+class QueueIndex:
+    # Зеркало очереди numbers в памяти по тарифам; счетчики по статусам ведет stats.
+    # Очередь тарифа — куча id, а не deque: номер после «Пропуска» возвращается на свое место, как в ORDER BY id
+    def __init__(self):
+        self.touched = None
+        self.reset()
+
+    def reset(self):
+        self.heaps = defaultdict(list)
+        self.items = {}
+        self.user_items = defaultdict(set)
+        self.by_tariff = Counter()
+
+    async def load(self, db):
+        # Пока идет запрос, хендлеры работают с прежним индексом; новый собирается без await между reset и заполнением.
+        # Номера, которые хендлеры тронули за время запроса, берутся из прежнего индекса — их изменения новее снимка
+        self.touched = set()
+        try:
+            rows = await (await db.execute(
+                "SELECT id, user_id, phone, tariff_name, tariff_price FROM numbers WHERE status='queue'"
+            )).fetchall()
+        finally:
+            touched, self.touched = self.touched, None
+        old = self.items
+        self.reset()
+        for r in rows:
+            self._push(QueueItem(*r))
+        for nid in touched:
+            self._detach(nid)
+            if nid in old: self._push(old[nid])
+        logger.info(f"📥 Queue index loaded: {len(self.items)} queued")
+
+    def _push(self, item):
+        if self.touched is not None: self.touched.add(item.id)
+        self.items[item.id] = item
+        self.user_items[item.user_id].add(item.id)
+        self.by_tariff[item.tariff_name] += 1
+        heapq.heappush(self.heaps[item.tariff_name], item.id)
+
+    def _detach(self, nid):
+        if self.touched is not None: self.touched.add(nid)
+        item = self.items.pop(nid, None)
+        if not item: return None
+        self.user_items[item.user_id].discard(nid)
+        if not self.user_items[item.user_id]: del self.user_items[item.user_id]
+        self.by_tariff[item.tariff_name] -= 1
+        # Удаленные id остаются в куче до извлечения; чистим, когда мусора становится много
+        heap = self.heaps[item.tariff_name]
+        if len(heap) > 2 * self.by_tariff[item.tariff_name] + 1000:
+            heap[:] = [i for i in heap if i in self.items]
+            heapq.heapify(heap)
+        return item
+
+    def add(self, item):
+        if item.id in self.items: return
+        self._push(item)
+
+    def remove(self, nid):
+        return self._detach(int(nid))
+
+    def remove_user(self, user_id):
+        return [self._detach(nid) for nid in list(self.user_items.get(user_id, ()))]
+
+    def pop(self, tariff_name):
+        heap = self.heaps[tariff_name]
+        while heap:
+            item = self._detach(heapq.heappop(heap))
+            if item: return item
+        return None
+
+    def queued(self, tariff_name=None):
+        return len(self.items) if tariff_name is None else self.by_tariff[tariff_name]
+
+    async def reconcile(self, db):
+        # Только очередь: частичный индекс, без прохода по истории
+        by_tariff = Counter({r[0]: r[1] for r in await (await db.execute(
+            "SELECT tariff_name, COUNT(*) FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue' GROUP BY tariff_name"
+        )).fetchall()})
+        if +self.by_tariff == by_tariff: return True
+        logger.warning(f"⚠️ Queue index drift: {dict(+self.by_tariff)} != {dict(by_tariff)}, reloading")
+        await self.load(db)
+        return False
+
+qindex = QueueIndex()
+
+async def qindex_watchdog():
+    while True:
+        await asyncio.sleep(QUEUE_RECONCILE_MINUTES * 60)
+        try:
+            # Под писателем: между чтением базы и сравнением никто не коммитит
+            t0 = time.perf_counter()
+            async with get_db() as db:
+                await qindex.reconcile(db)
+                await routes.reconcile(db)
+            metrics.observe("bot_reconcile_seconds", time.perf_counter() - t0)
+        except Exception as e:
+            logger.exception(f"Queue reconcile error: {e}")
+
+# ==========================================
+# МАРШРУТЫ МОСТА
+# ==========================================
+
+Route = namedtuple("Route", "id user_id phone worker_id worker_chat_id worker_thread_id start_time wait_code_start")
+ROUTE_COLS = ", ".join(Route._fields)
+
+class RouteTable:
+    # Номера в работе в памяти: телефон → маршрут и юзер → маршруты. Мост, /code и /sms базу не читают.
+    # Меняется после коммита перехода; соседние процессы узнают об изменениях из ленты shared
+    def __init__(self):
+        self.touched = None
+        self.reset()
+
+    def reset(self):
+        self.items = {}
+        self.by_phone = {}
+        self.by_user = defaultdict(dict)
+
+    async def load(self, db):
+        # Как QueueIndex.load: мост не видит пустую таблицу, тронутые во время запроса маршруты берутся из прежней
+        self.touched = set()
+        try:
+            rows = await (await db.execute(
+                f"SELECT {ROUTE_COLS} FROM numbers INDEXED BY idx_numbers_status WHERE status IN ('work','active')"
+            )).fetchall()
+        finally:
+            touched, self.touched = self.touched, None
+        old = self.items
+        self.reset()
+        for r in rows:
+            self._put(Route(*r))
+        for nid in touched:
+            self._drop(nid)
+            if nid in old: self._put(old[nid])
+        logger.info(f"🔀 Routes loaded: {len(self.items)} live numbers")
+
+    def _put(self, route):
+        self._drop(route.id)
+        self.items[route.id] = route
+        self.by_phone[route.phone] = route
+        self.by_user[route.user_id][route.id] = route
+
+    def _drop(self, nid):
+        if self.touched is not None: self.touched.add(nid)
+        route = self.items.pop(nid, None)
+        if not route: return None
+        if self.by_phone.get(route.phone, route).id == nid: self.by_phone.pop(route.phone, None)
+        self.by_user[route.user_id].pop(nid, None)
+        if not self.by_user[route.user_id]: del self.by_user[route.user_id]
+        return route
+
+    def add(self, row):
+        self._put(Route._make(row[f] for f in Route._fields))
+
+    def remove(self, nid):
+        return self._drop(int(nid))
+
+    def set_wait(self, nid, wait_code_start):
+        route = self.items.get(int(nid))
+        if route: self._put(route._replace(wait_code_start=wait_code_start))
+
+    def phone(self, phone):
+        return self.by_phone.get(phone)
+
+    def pick(self, user_id, hint=None):
+        # Несколько номеров в работе: номер из сообщения, на которое ответил юзер,
+        # иначе тот, по которому ждут код, иначе взятый последним
+        mine = self.by_user.get(user_id)
+        if not mine: return None
+        if len(mine) == 1: return next(iter(mine.values()))
+        if hint:
+            for r in mine.values():
+                if r.phone in hint or mask_phone(r.phone, user_id) in hint: return r
+        return max(mine.values(), key=lambda r: (r.wait_code_start or 0, r.start_time or 0, r.id))
+
+    async def publish(self, *nids):
+        if nids: await shared.publish("route:" + ",".join(map(str, nids)))
+
+    async def refresh(self, nids):
+        async with get_db(readonly=True) as db:
+            for nid in nids:
+                row = await (await db.execute(
+                    f"SELECT {ROUTE_COLS} FROM numbers WHERE id=? AND status IN ('work','active')", (nid,)
+                )).fetchone()
+                if row: self._put(Route(*row))
+                else: self._drop(nid)
+
+    async def reconcile(self, db):
+        live = {r[0]: r[1] for r in await (await db.execute(
+            "SELECT id, wait_code_start FROM numbers INDEXED BY idx_numbers_status WHERE status IN ('work','active')"
+        )).fetchall()}
+        if live == {nid: r.wait_code_start for nid, r in self.items.items()}: return True
+        logger.warning(f"⚠️ Route table drift: {len(self.items)} routes, {len(live)} live numbers, reloading")
+        await self.load(db)
+        return False
+
+routes = RouteTable()
+
+# ==========================================
+# СТАТИСТИКА
+# ==========================================
+
+class StatsCounters:
+    # Счетчики номеров по статусам в разрезах: all, user, tariff, group (чат воркеров).
+    # Меняются в той же транзакции, что и статус номера, поэтому таблица совпадает с numbers;
+    # дашборды читают таблицу по первичному ключу — видны только закоммиченные изменения всех процессов.
+    # Очередь к группе не относится: у номера в очереди нет чата
+    @staticmethod
+    def _scopes(user_id, tariff_name, chat_id, status):
+        yield ("all", "")
+        yield ("user", str(user_id))
+        yield ("tariff", tariff_name)
+        if chat_id and status != 'queue': yield ("group", str(chat_id))
+
+    async def move(self, db, user_id, tariff_name, old, new, chat_id=0, n=1):
+        # old/new = None — строка появилась/удалена
+        deltas = Counter()
+        for status, sign in ((old, -n), (new, n)):
+            if not status: continue
+            for scope in self._scopes(user_id, tariff_name, chat_id, status):
+                deltas[(*scope, status)] += sign
+        deltas = {k: v for k, v in deltas.items() if v}
+        if not deltas: return
+        await db.executemany("""
+            INSERT INTO stats_counters (scope, key, status, n) VALUES (?, ?, ?, ?)
+            ON CONFLICT (scope, key, status) DO UPDATE SET n = n + excluded.n
+        """, [(*k, v) for k, v in deltas.items()])
+
+    async def read(self, db, scope, key):
+        return +Counter(dict(await (await db.execute(
+            "SELECT status, n FROM stats_counters WHERE scope=? AND key=?", (scope, str(key))
+        )).fetchall()))
+
+    async def get(self, db, scope, key, *statuses):
+        c = await self.read(db, scope, key)
+        return max(sum(c[st] for st in statuses), 0)
+
+    async def total(self, db, scope, key):
+        return max(sum((await self.read(db, scope, key)).values()), 0)
+
+    async def by_status(self, db):
+        return await self.read(db, "all", "")
+
+    async def reconcile(self, db):
+        # Один проход по numbers и архиву при старте: пересчитываем все разрезы и чиним расхождения с таблицей.
+        # Пересчет и перезапись — под одной блокировкой записи: иначе stats.move соседнего процесса,
+        # закоммиченный между чтением и DELETE, затерся бы навсегда
+        await db.execute("BEGIN IMMEDIATE")
+        fresh = defaultdict(Counter)
+        cur = await db.execute(*await archive.union(db, """
+            SELECT user_id, tariff_name, worker_chat_id, status, COUNT(*) FROM {t}
+            GROUP BY user_id, tariff_name, worker_chat_id, status
+        """))
+        while chunk := await cur.fetchmany(5000):
+            for uid, tariff, chat, status, n in chunk:
+                for scope in self._scopes(uid, tariff, chat, status):
+                    fresh[scope][status] += n
+
+        stored = defaultdict(Counter)
+        for scope, key, status, n in await (await db.execute(
+            "SELECT scope, key, status, n FROM stats_counters WHERE n<>0"
+        )).fetchall():
+            stored[(scope, key)][status] = n
+
+        drift = {k for k in fresh.keys() | stored.keys() if +fresh.get(k, Counter()) != +stored.get(k, Counter())}
+        if not drift:
+            await db.rollback()
+            return True
+        logger.warning(f"⚠️ Stats drift in {len(drift)} counters, rewriting")
+        await db.execute("DELETE FROM stats_counters")
+        await db.executemany(
+            "INSERT INTO stats_counters (scope, key, status, n) VALUES (?, ?, ?, ?)",
+            [(scope, key, status, n) for (scope, key), c in fresh.items() for status, n in c.items() if n]
+        )
+        await db.commit()
+        return False
+
+stats = StatsCounters()
+
+# ==========================================
+# ЖИЗНЕННЫЙ ЦИКЛ НОМЕРА
+# ==========================================
+
+# Действие -> (из каких статусов, в какой). None — строка удаляется.
+# finished, dead и finished_group_N — финальные: из них переходов нет
+TRANSITIONS = {
+    "claim": (('queue',), 'work'),
+    "activate": (('work',), 'active'),
+    "skip": (('work',), 'queue'),
+    "drop": (('work', 'active'), 'finished'),
+    "error": (('work', 'active'), 'dead'),
+    "timeout": (('active',), 'dead'),
+    "stop": (('work', 'active'), 'finished_group_{gn}'),
+    "delete": (('queue',), None),
+}
+
+STALE_TEXT = "ℹ️ Номер уже обработан"
+
+async def transition(db, row, action, guard=(), **sets):
+    # CAS: строка меняется, только если status и version те же, что в прочитанной row (и колонки из guard).
+    # None — переход уже неприменим: дубль колбэка, гонка с таймаутом или с соседним процессом.
+    # Счетчики двигаются в той же транзакции; коммит — за вызывающим
+    src, dst = TRANSITIONS[action]
+    if row['status'] not in src: return None
+    checks = ("status", "version", *guard)
+    where = " AND ".join(f"{col} IS ?" for col in checks)
+    args = (row['id'], *(row[col] for col in checks))
+    if dst is None:
+        new = await (await db.execute(f"DELETE FROM numbers WHERE id=? AND {where} RETURNING *", args)).fetchone()
+    else:
+        cols = {"status": dst, **sets}
+        new = await (await db.execute(
+            f"UPDATE numbers SET {', '.join(f'{col}=?' for col in cols)}, version=version+1 WHERE id=? AND {where} RETURNING *",
+            (*cols.values(), *args)
+        )).fetchone()
+    if new: await stats.move(db, row['user_id'], row['tariff_name'], row['status'], dst, row['worker_chat_id'])
+    return new
+
+# ==========================================
+# ДОСТУП
+# ==========================================
+
+class AccessCache:
+    # LRU с TTL поверх users: (is_approved, is_banned) или None, если юзер еще не нажимал /start.
+    # cb_acc и cmd_start сбрасывают запись через changed(): здесь сразу, в соседних процессах — по ленте shared.
+    # После обрыва ленты ("all") кэш очищается целиком
+    def __init__(self, ttl, size):
+        self.ttl = ttl
+        self.size = size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, uid):
+        now = time.monotonic()
+        entry = self.items.get(uid)
+        if entry and entry[0] > now:
+            self.items.move_to_end(uid)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        async with get_db(readonly=True) as db:
+            row = await (await db.execute(
+                "SELECT is_approved, is_banned FROM users WHERE user_id=?", (uid,)
+            )).fetchone()
+        flags = (bool(row['is_approved']), bool(row['is_banned'])) if row else None
+        self.items[uid] = (now + self.ttl, flags)
+        self.items.move_to_end(uid)
+        if len(self.items) > self.size: self.items.popitem(last=False)
+        return flags
+
+    def invalidate(self, uid):
+        self.items.pop(uid, None)
+
+    async def changed(self, uid):
+        self.invalidate(uid)
+        await shared.publish(f"access:{uid}")
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "size": len(self.items),
+        }
+
+access = AccessCache(ACCESS_TTL, ACCESS_CACHE_SIZE)
+
+async def access_guard(handler, event, data):
+    # Внешний middleware роутера: не одобренных и забаненных отсекаем до фильтров и хендлеров.
+    # Проверяются только личные чаты; топики воркеров, админ и /start проходят без проверки
+    user = event.from_user
+    chat = event.chat if isinstance(event, Message) else (event.message.chat if event.message else None)
+    if not user or user.id == ADMIN_ID or not chat or chat.type != "private":
+        return await handler(event, data)
+    if isinstance(event, Message) and event.text and event.text.startswith("/start"):
+        return await handler(event, data)
+
+    flags = await access.get(user.id)
+    if flags and flags[0] and not flags[1]:
+        return await handler(event, data)
+
+    phases = PHASES.get()
+    if phases is not None: phases["handler"] = "access_guard"
+    if flags and flags[1]: text = "🚫 Вы заблокированы."
+    elif flags: text = "⏳ Ваша заявка все еще на рассмотрении."
+    else: text = "👋 Нажмите /start"
+
+    if isinstance(event, CallbackQuery):
+        return await event.answer(text, show_alert=True)
+    # Забаненным в личке не отвечаем, чтобы спам не превращался в исходящие
+    if not (flags and flags[1]): await event.answer(text)
 
 # ==========================================
 # FSM СОСТОЯНИЯ
@@ -167,6 +1590,9 @@ def worker_kb_max(nid):
 def worker_active_kb(nid):
     return InlineKeyboardBuilder().button(text="📉 Слет", callback_data=f"w_drop_{nid}").as_markup()
 
+def afk_kb(uid):
+    return InlineKeyboardBuilder().button(text="👋 Я тут!", callback_data=f"afk_ok_{uid}").as_markup()
+
 # ==========================================
 # КОМАНДЫ
 # ==========================================
@@ -178,34 +1604,42 @@ async def cmd_start(m: Message, state: FSMContext):
     username = m.from_user.username or "NoUsername"
     first_name = m.from_user.first_name or "User"
 
-    async with get_db() as db:
+    # Под писателем — только SQL и commit; ответы в Telegram уходят после блока
+    async with get_db(readonly=True) as db:
         user = await (await db.execute("SELECT * FROM users WHERE user_id=?", (uid,))).fetchone()
 
-        if not user:
-            await db.execute(
-                "INSERT INTO users (user_id, username, first_name, last_afk_check) VALUES (?, ?, ?, ?)", 
+    if not user:
+        async with get_db() as db:
+            # Два /start подряд: заявку админу шлет только тот, кто вставил строку
+            cur = await db.execute(
+                "INSERT OR IGNORE INTO users (user_id, username, first_name, last_afk_check) VALUES (?, ?, ?, ?)", 
                 (uid, username, first_name, get_now())
             )
             await db.commit()
-            
-            if ADMIN_ID:
-                try:
-                    kb = InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="✅ Принять", callback_data=f"acc_ok_{uid}"), 
-                        InlineKeyboardButton(text="🚫 Бан", callback_data=f"acc_no_{uid}")
-                    ]])
-                    await m.bot.send_message(ADMIN_ID, f"👤 <b>Новый запрос:</b>\nID: {uid}\n@{username}", reply_markup=kb, parse_mode="HTML")
-                except: pass
-            
-            return await m.answer("🔒 <b>Доступ ограничен.</b>\nОжидайте одобрения администратора.", parse_mode="HTML")
-
-        if user['is_banned']:
-            return await m.answer("🚫 Вы заблокированы.")
+        await access.changed(uid)
         
-        if user['is_approved']:
-            return await m.answer(f"👋 Привет, <b>{first_name}</b>!\n{SEP}", reply_markup=main_kb(uid), parse_mode="HTML")
-        else:
-            return await m.answer("⏳ Ваша заявка все еще на рассмотрении.")
+        if ADMIN_ID and cur.rowcount:
+            kb = InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="✅ Принять", callback_data=f"acc_ok_{uid}"), 
+                InlineKeyboardButton(text="🚫 Бан", callback_data=f"acc_no_{uid}")
+            ]])
+            outbox.send(ADMIN_ID, f"👤 <b>Новый запрос:</b>\nID: {uid}\n@{username}", reply_markup=kb, parse_mode="HTML")
+        
+        return await m.answer("🔒 <b>Доступ ограничен.</b>\nОжидайте одобрения администратора.", parse_mode="HTML")
+
+    if user['is_banned']:
+        return await m.answer("🚫 Вы заблокированы.")
+
+    # Юзер снова написал боту — значит, больше не блокирует его
+    if user['is_blocked']:
+        async with get_db() as db:
+            await db.execute("UPDATE users SET is_blocked=0 WHERE user_id=?", (uid,))
+            await db.commit()
+    
+    if user['is_approved']:
+        return await m.answer(f"👋 Привет, <b>{first_name}</b>!\n{SEP}", reply_markup=main_kb(uid), parse_mode="HTML")
+    else:
+        return await m.answer("⏳ Ваша заявка все еще на рассмотрении.")
 
 @router.message(Command("bindgroup"))
 async def cmd_bindgroup(m: Message, command: CommandObject):
@@ -244,38 +1678,35 @@ async def cmd_bindgroup(m: Message, command: CommandObject):
 async def cmd_startwork(m: Message):
     if m.from_user.id != ADMIN_ID: return
 
-    async with get_db() as db:
-        tariffs = await (await db.execute("SELECT name FROM tariffs")).fetchall()
-
-    kb = InlineKeyboardBuilder()
-    for t in tariffs: kb.button(text=t['name'], callback_data=f"bind_{t['name']}")
-    kb.adjust(1)
-
-    await m.answer("⚙️ Выберите тариф для топика:", reply_markup=kb.as_markup())
+    await m.answer("⚙️ Выберите тариф для топика:", reply_markup=config.keyboards["bind"])
 
 @router.message(Command("num"))
 async def cmd_num(m: Message, bot: Bot):
     tid = m.message_thread_id if m.is_topic_message else 0
-    key = f"topic_{m.chat.id}_{tid}"
 
-    async with get_db() as db:
-        conf = await (await db.execute("SELECT value FROM config WHERE key=?", (key,))).fetchone()
-        if not conf: return await m.reply(f"❌ Топик не настроен. Используйте /startwork")
-        
-        tariff_name = conf['value']
-        
-        row = await (await db.execute(
-            "SELECT * FROM numbers WHERE status='queue' AND tariff_name=? ORDER BY id ASC LIMIT 1",
-            (tariff_name,)
-        )).fetchone()
-        
-        if not row: return await m.reply("📭 Очередь пуста")
-        
-        await db.execute("""
-            UPDATE numbers SET status='work', worker_id=?, worker_chat_id=?, worker_thread_id=?, start_time=? WHERE id=?
-        """, (m.from_user.id, m.chat.id, tid, get_now(), row['id']))
-        await db.execute("UPDATE users SET last_afk_check=? WHERE user_id=?", (get_now(), row['user_id']))
-        await db.commit()
+    tariff_name = config.binding(m.chat.id, tid)
+    if not tariff_name: return await m.reply(f"❌ Топик не настроен. Используйте /startwork")
+
+    # CAS в claim_number и так не даст выдать номер дважды; блокировка убирает гонку процессов за голову очереди
+    try:
+        async with shared.claim_lock(tariff_name), get_db() as db:
+            # Кандидата берем из индекса в памяти; если индекс отстал от базы — обычный захват по SQL
+            row = None
+            while not row and (item := qindex.pop(tariff_name)):
+                row = await claim_number(db, tariff_name, m.from_user.id, m.chat.id, tid, nid=item.id)
+            if not row:
+                row = await claim_number(db, tariff_name, m.from_user.id, m.chat.id, tid)
+            if row:
+                await stats.move(db, row['user_id'], tariff_name, 'queue', 'work', m.chat.id)
+                await db.commit()
+    except LockError:
+        # Другой процесс держит очередь тарифа дольше CLAIM_LOCK_SECONDS
+        return await m.reply("⏳ Очередь занята, повторите /num")
+    if not row: return await m.reply("📭 Очередь пуста")
+    qindex.remove(row['id'])
+    routes.add(row)
+    await routes.publish(row['id'])
+    await writes.put("afk_seen", row['user_id'], get_now())
 
     # Сообщение воркеру
     if "MAX" in tariff_name.upper():
@@ -297,13 +1728,11 @@ async def cmd_num(m: Message, bot: Bot):
 
     await m.answer(msg, reply_markup=kb, parse_mode="HTML")
 
-    try:
-        await bot.send_message(
-            row['user_id'],
-            f"⚡ <b>Ваш номер взяли!</b>\n📱 {mask_phone(row['phone'], row['user_id'])}\nОжидайте код.",
-            parse_mode="HTML"
-        )
-    except: pass
+    outbox.send(
+        row['user_id'],
+        f"⚡ <b>Ваш номер взяли!</b>\n📱 {mask_phone(row['phone'], row['user_id'])}\nОжидайте код.",
+        parse_mode="HTML"
+    )
 
 @router.message(Command("code"))
 async def cmd_code(m: Message, command: CommandObject, bot: Bot):
@@ -312,33 +1741,26 @@ async def cmd_code(m: Message, command: CommandObject, bot: Bot):
 
     ph = clean_phone(command.args.split()[0])
 
-    async with get_db() as db:
-        row = await (await db.execute(
-            "SELECT * FROM numbers WHERE phone=? AND status IN ('work','active')",
-            (ph,)
-        )).fetchone()
-
-    if not row or row['worker_id'] != m.from_user.id:
+    row = routes.phone(ph)
+    if not row or row.worker_id != m.from_user.id:
         return await m.reply("❌ Не ваш номер")
 
-    async with get_db() as db:
-        await db.execute(
-            "UPDATE numbers SET wait_code_start=? WHERE id=?",
-            (get_now(), row['id'])
-        )
-        await db.commit()
-
-    try:
-        await bot.send_message(
-            row['user_id'],
-            f"🔔 <b>Офис запросил код</b>\n{SEP}\n"
-            f"📱 {mask_phone(row['phone'], row['user_id'])}\n\n"
-            f"Ответьте сообщением ниже",
-            parse_mode="HTML"
-        )
-        await m.reply("✅ Запрос отправлен юзеру")
-    except:
-        await m.reply("❌ Ошибка доставки")
+    now = get_now()
+    routes.set_wait(row.id, now)
+    # Соседние процессы перечитывают маршрут из базы, поэтому оповещаем их после коммита пачки
+    await writes.put("code_wait", row.id, now, then=lambda: routes.publish(row.id))
+    timers.arm("code", row.id, now / 1000 + CODE_WAIT_MINUTES * 60)
+
+    outbox.send(
+        row.user_id,
+        f"🔔 <b>Офис запросил код</b>\n{SEP}\n"
+        f"📱 {mask_phone(row.phone, row.user_id)}\n\n"
+        f"Ответьте сообщением ниже",
+        prio=PRIO_BRIDGE,
+        parse_mode="HTML",
+        on_fail=lambda: m.reply("❌ Ошибка доставки")
+    )
+    await m.reply("✅ Запрос отправлен юзеру")
 
 # ==========================================
 # CALLBACK HANDLERS
@@ -371,10 +1793,10 @@ async def cb_guide(c: CallbackQuery):
 @router.callback_query(F.data == "profile")
 async def cb_profile(c: CallbackQuery):
     uid = c.from_user.id
-    async with get_db() as db:
-        total = (await (await db.execute("SELECT COUNT(*) FROM numbers WHERE user_id=?", (uid,))).fetchone())[0]
-        active = (await (await db.execute("SELECT COUNT(*) FROM numbers WHERE user_id=? AND status IN ('work','active')", (uid,))).fetchone())[0]
-        queue = (await (await db.execute("SELECT COUNT(*) FROM numbers WHERE user_id=? AND status='queue'", (uid,))).fetchone())[0]
+    async with get_db(readonly=True) as db:
+        counts = await stats.read(db, "user", uid)
+    total = sum(counts.values())
+    queue, active = counts['queue'], counts['work'] + counts['active']
 
     kb = InlineKeyboardBuilder()
     if queue > 0: kb.button(text="📝 Мои номера", callback_data="my_nums")
@@ -395,7 +1817,7 @@ async def cb_profile(c: CallbackQuery):
 @router.callback_query(F.data == "my_nums")
 async def cb_my_nums(c: CallbackQuery):
     uid = c.from_user.id
-    async with get_db() as db:
+    async with get_db(readonly=True) as db:
         rows = await (await db.execute(
             "SELECT id, phone, status, tariff_price FROM numbers WHERE user_id=? AND status='queue' ORDER BY id ASC LIMIT 10",
             (uid,)
@@ -422,48 +1844,40 @@ async def cb_del(c: CallbackQuery):
     nid = c.data.split("_")[1]
     async with get_db() as db:
         row = await (await db.execute(
-            "SELECT status FROM numbers WHERE id=? AND user_id=?",
+            "SELECT * FROM numbers WHERE id=? AND user_id=?",
             (nid, c.from_user.id)
         )).fetchone()
-        
-        if row and row['status'] == 'queue':
-            await db.execute("DELETE FROM numbers WHERE id=?", (nid,))
-            await db.commit()
-            await c.answer("✅ Номер удален")
-            await cb_my_nums(c)
-        else:
-            await c.answer("❌ Номер уже в работе!", show_alert=True)
+        deleted = row and await transition(db, row, "delete")
+        if deleted: await db.commit()
+
+    if not deleted:
+        return await c.answer("❌ Номер уже в работе!", show_alert=True)
+    qindex.remove(row['id'])
+    await c.answer("✅ Номер удален")
+    await cb_my_nums(c)
 
 @router.callback_query(F.data == "sel_tariff")
 async def cb_sel_tariff(c: CallbackQuery):
-    async with get_db() as db:
-        tariffs = await (await db.execute("SELECT * FROM tariffs")).fetchall()
-
-    kb = InlineKeyboardBuilder()
-    for t in tariffs:
-        kb.button(text=f"{t['name']} | {t['price']}", callback_data=f"pick_{t['name']}")
-    kb.button(text="🔙 Меню", callback_data="back_main")
-    kb.adjust(1)
-
-    await c.message.edit_text(f"📂 <b>Выберите тариф</b>\n{SEP}", reply_markup=kb.as_markup(), parse_mode="HTML")
+    await c.message.edit_text(f"📂 <b>Выберите тариф</b>\n{SEP}", reply_markup=config.keyboards["pick"], parse_mode="HTML")
     await c.answer()
 
 @router.callback_query(F.data.startswith("pick_"))
 async def cb_pick(c: CallbackQuery, state: FSMContext):
     tn = c.data.split("_", 1)[1]
-    async with get_db() as db:
-        t = await (await db.execute("SELECT * FROM tariffs WHERE name=?", (tn,))).fetchone()
+    t = config.tariff(tn)
+    if not t: return await c.answer("❌ Тариф не найден", show_alert=True)
 
-    await state.update_data(tariff=tn, price=t['price'], work_time=t['work_time'])
+    await state.update_data(tariff=tn, price=t.price, work_time=t.work_time)
     await state.set_state(UserState.waiting_numbers)
 
     kb = InlineKeyboardBuilder().button(text="🔙 Отмена", callback_data="back_main")
 
     await c.message.edit_text(
         f"💎 <b>Тариф: {tn}</b>\n{SEP}\n"
-        f"💰 Прайс: {t['price']}\n"
-        f"⏰ Время работы: {t['work_time']}\n\n"
-        f"📱 Отправьте номера списком (каждый с новой строки)",
+        f"💰 Прайс: {t.price}\n"
+        f"⏰ Время работы: {t.work_time}\n\n"
+        f"📱 Отправьте номера списком (каждый с новой строки)\n"
+        f"📎 Или файлом .txt / .csv",
         reply_markup=kb.as_markup(),
         parse_mode="HTML"
     )
@@ -488,12 +1902,7 @@ async def cb_bind(c: CallbackQuery):
     cid = c.message.chat.id
     tid = c.message.message_thread_id if c.message.is_topic_message else 0
 
-    async with get_db() as db:
-        await db.execute(
-            "INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)",
-            (f"topic_{cid}_{tid}", tn)
-        )
-        await db.commit()
+    await config.set_binding(cid, tid, tn)
 
     await c.message.edit_text(
         f"✅ <b>Топик привязан к тарифу: {tn}</b>\n\n"
@@ -507,12 +1916,19 @@ async def cb_w_act(c: CallbackQuery, bot: Bot):
     nid = c.data.split("_")[2]
     async with get_db() as db:
         row = await (await db.execute("SELECT * FROM numbers WHERE id=?", (nid,))).fetchone()
-        
-        if not row or row['worker_id'] != c.from_user.id:
-            return await c.answer("🚫 Не ваш номер!", show_alert=True)
-        
-        await db.execute("UPDATE numbers SET status='active' WHERE id=?", (nid,))
-        await db.commit()
+        mine = row and row['worker_id'] == c.from_user.id
+        done = mine and await transition(db, row, "activate")
+        if done: await db.commit()
+
+    if not mine: return await c.answer("🚫 Не ваш номер!", show_alert=True)
+    # Повторное нажатие или гонка с другим действием: ни записи, ни уведомлений
+    if not done: return await c.answer(STALE_TEXT)
+    # Код запросили, пока номер был в 'work': таймаут начинает действовать после «Встал».
+    # Отметка запроса могла еще не доехать до базы — берем ее из маршрута
+    route = routes.items.get(row['id'])
+    wait = route.wait_code_start if route else row['wait_code_start']
+    if wait:
+        timers.arm("code", row['id'], wait / 1000 + CODE_WAIT_MINUTES * 60)
 
     await c.message.edit_text(
         f"✅ <b>Номер встал</b>\n📱 {row['phone']}",
@@ -520,9 +1936,7 @@ async def cb_w_act(c: CallbackQuery, bot: Bot):
         parse_mode="HTML"
     )
 
-    try:
-        await bot.send_message(row['user_id'], "✅ Номер встал и работает!")
-    except: pass
+    outbox.send(row['user_id'], "✅ Номер встал и работает!")
     await c.answer()
 
 @router.callback_query(F.data.startswith("w_skip_"))
@@ -530,42 +1944,42 @@ async def cb_w_skip(c: CallbackQuery, bot: Bot):
     nid = c.data.split("_")[2]
     async with get_db() as db:
         row = await (await db.execute("SELECT * FROM numbers WHERE id=?", (nid,))).fetchone()
-        
-        if not row or row['worker_id'] != c.from_user.id:
-            return await c.answer("🚫 Не ваш номер!", show_alert=True)
-        
-        await db.execute(
-            "UPDATE numbers SET status='queue', worker_id=0, worker_chat_id=0, worker_thread_id=0 WHERE id=?",
-            (nid,)
-        )
-        await db.commit()
+        mine = row and row['worker_id'] == c.from_user.id
+        done = mine and await transition(db, row, "skip", worker_id=0, worker_chat_id=0, worker_thread_id=0)
+        if done:
+            afk = await (await db.execute(
+                "SELECT last_afk_check, afk_pending_since FROM users WHERE user_id=?", (row['user_id'],)
+            )).fetchone()
+            await db.commit()
+
+    if not mine: return await c.answer("🚫 Не ваш номер!", show_alert=True)
+    if not done: return await c.answer(STALE_TEXT)
+    qindex.add(QueueItem(row['id'], row['user_id'], row['phone'], row['tariff_name'], row['tariff_price']))
+    if afk: afk_arm(*afk)
+    routes.remove(row['id'])
+    await routes.publish(row['id'])
 
     await c.message.edit_text("⏭ <b>Пропуск</b>\nНомер вернулся в очередь", parse_mode="HTML")
 
-    try:
-        await bot.send_message(row['user_id'], "⏭ Офис пропустил ваш номер")
-    except: pass
+    outbox.send(row['user_id'], "⏭ Офис пропустил ваш номер")
     await c.answer()
 
 @router.callback_query(F.data.startswith(("w_drop_", "w_err_")))
 async def cb_w_finish(c: CallbackQuery, bot: Bot):
     nid = c.data.split("_")[2]
     is_drop = "drop" in c.data
+    end_time = get_now()
     async with get_db() as db:
         row = await (await db.execute("SELECT * FROM numbers WHERE id=?", (nid,))).fetchone()
-        
-        if not row or row['worker_id'] != c.from_user.id:
-            return await c.answer("🚫 Не ваш номер!", show_alert=True)
-        
-        status = "finished" if is_drop else "dead"
-        end_time = get_now()
-        duration = calc_duration(row['start_time'], end_time)
-        
-        await db.execute(
-            "UPDATE numbers SET status=?, end_time=? WHERE id=?",
-            (status, end_time, nid)
-        )
-        await db.commit()
+        mine = row and row['worker_id'] == c.from_user.id
+        done = mine and await transition(db, row, "drop" if is_drop else "error", end_time=end_time)
+        if done: await db.commit()
+
+    if not mine: return await c.answer("🚫 Не ваш номер!", show_alert=True)
+    if not done: return await c.answer(STALE_TEXT)
+    duration = calc_duration(row['start_time'], end_time)
+    routes.remove(row['id'])
+    await routes.publish(row['id'])
 
     if is_drop:
         msg = f"📉 <b>Слет</b>\n⏱ {duration}"
@@ -576,9 +1990,7 @@ async def cb_w_finish(c: CallbackQuery, bot: Bot):
 
     await c.message.edit_text(msg, parse_mode="HTML")
 
-    try:
-        await bot.send_message(row['user_id'], user_msg)
-    except: pass
+    outbox.send(row['user_id'], user_msg)
     await c.answer()
 
 @router.callback_query(F.data.startswith("acc_"))
@@ -586,19 +1998,17 @@ async def cb_acc(c: CallbackQuery, bot: Bot):
     if c.from_user.id != ADMIN_ID: return
     action, uid = c.data.split("_")[1], int(c.data.split("_")[2])
 
+    col = "is_approved" if action == "ok" else "is_banned"
     async with get_db() as db:
-        if action == "ok":
-            await db.execute("UPDATE users SET is_approved=1 WHERE user_id=?", (uid,))
-            await db.commit()
-            await c.message.edit_text(f"✅ Юзер {uid} принят")
-            
-            try:
-                await bot.send_message(uid, "✅ Доступ открыт!\nЖмите /start")
-            except: pass
-        else:
-            await db.execute("UPDATE users SET is_banned=1 WHERE user_id=?", (uid,))
-            await db.commit()
-            await c.message.edit_text(f"🚫 Юзер {uid} забанен")
+        await db.execute(f"UPDATE users SET {col}=1 WHERE user_id=?", (uid,))
+        await db.commit()
+    await access.changed(uid)
+
+    if action == "ok":
+        await c.message.edit_text(f"✅ Юзер {uid} принят")
+        outbox.send(uid, "✅ Доступ открыт!\nЖмите /start")
+    else:
+        await c.message.edit_text(f"🚫 Юзер {uid} забанен")
 
     await c.answer()
 
@@ -608,9 +2018,7 @@ async def cb_afk(c: CallbackQuery):
     if c.from_user.id != uid:
         return await c.answer("🚫 Не для вас!", show_alert=True)
         
-    async with get_db() as db:
-        await db.execute("UPDATE users SET last_afk_check=? WHERE user_id=?", (get_now(), uid))
-        await db.commit()
+    await writes.put("afk_ok", uid, get_now())
 
     try: await c.message.delete()
     except: pass
@@ -636,47 +2044,96 @@ async def cb_adm(c: CallbackQuery):
     await c.message.edit_text("⚡ <b>Админ панель</b>\n{SEP}", reply_markup=kb.as_markup(), parse_mode="HTML")
     await c.answer()
 
-@router.callback_query(F.data == "all_queue")
-async def cb_all_queue(c: CallbackQuery):
-    if c.from_user.id != ADMIN_ID: return
-    async with get_db() as db:
-        queue = await (await db.execute(
-            "SELECT id, phone, tariff_name FROM numbers WHERE status='queue' ORDER BY id ASC"
-        )).fetchall()
-        
-        active = await (await db.execute(
-            "SELECT id, phone, tariff_name, worker_id FROM numbers WHERE status IN ('work', 'active') ORDER BY id ASC"
-        )).fetchall()
+# Браузер очереди: ключ фильтра -> (статус, заголовок)
+QUEUE_VIEWS = {"q": ("queue", "🟡 В очереди"), "w": ("work", "🔵 В работе"), "a": ("active", "🟢 Встали")}
 
-    txt = f"📋 <b>ОБЩАЯ ОЧЕРЕДЬ</b>\n{SEP}\n\n"
+def queue_cb(st, ti, wid, cursor):
+    # aq:<статус>:<номер тарифа или ->:<воркер или 0>:<курсор: >id вперед, <id назад> — в пределах 64 байт
+    return f"aq:{st}:{ti}:{wid}:{cursor}"
 
-    txt += f"🟡 <b>В ОЧЕРЕДИ ({len(queue)}):</b>\n"
-    if queue:
-        for i, r in enumerate(queue[:20], 1):
-            txt += f"{i}. {r['phone']} | {r['tariff_name']}\n"
-        if len(queue) > 20:
-            txt += f"...и еще {len(queue) - 20} номеров\n"
-    else:
-        txt += "Пусто\n"
-
-    txt += f"\n🟢 <b>В РАБОТЕ ({len(active)}):</b>\n"
-    if active:
-        for r in active[:20]:
-            txt += f"📱 {r['phone']} | {r['tariff_name']} | Воркер: {r['worker_id']}\n"
-        if len(active) > 20:
-            txt += f"...и еще {len(active) - 20} номеров\n"
-    else:
-        txt += "Пусто\n"
+async def queue_page(st="q", ti="-", wid=0, cursor=">0"):
+    if st not in QUEUE_VIEWS: st = "q"
+    status, title = QUEUE_VIEWS[st]
+    names = list(config.tariffs)
+    tariff = names[int(ti)] if ti.isdigit() and int(ti) < len(names) else None
+    if not tariff: ti = "-"
+    if status == 'queue': wid = 0
+    back, after = cursor[0] == "<", int(cursor[1:])
+
+    filters = ([tariff] if tariff else []) + ([wid] if wid else [])
+    async with get_db(readonly=True) as db:
+        rows = await (await db.execute(
+            queue_page_sql(status, bool(tariff), bool(wid), back), (*filters, after, QUEUE_PAGE_SIZE + 1)
+        )).fetchall()
+        # Итоги — из счетчиков; по воркеру счетчиков нет, но его живые номера считаются по частичному индексу
+        if wid:
+            total = (await (await db.execute(
+                "SELECT COUNT(*) FROM numbers WHERE status IN ('work','active') AND status=? AND worker_id=?"
+                + (" AND tariff_name=?" if tariff else ""), (status, wid, *filters[:-1])
+            )).fetchone())[0]
+        else:
+            total = await stats.get(db, "tariff", tariff, status) if tariff else await stats.get(db, "all", "", status)
+        per_tariff = [(n, await stats.get(db, "tariff", n, status)) for n in names]
+
+    more = len(rows) > QUEUE_PAGE_SIZE
+    rows = rows[:QUEUE_PAGE_SIZE]
+    if back: rows.reverse()
+    has_prev = more if back else after > 0
+    has_next = True if back else more
+
+    lines = ["📋 <b>ОБЩАЯ ОЧЕРЕДЬ</b>", SEP, f"{title}: <b>{total}</b>"]
+    if names: lines.append(" · ".join(f"{n}: {cnt}" for n, cnt in per_tariff))
+    if tariff or wid:
+        lines.append("🔎 " + ", ".join(([f"тариф {tariff}"] if tariff else []) + ([f"воркер {wid}"] if wid else [])))
+    lines.append("")
+    for r in rows:
+        who = f"👤 {r['user_id']}" if status == 'queue' else f"Воркер: {r['worker_id']}"
+        lines.append(f"#{r['id']} {r['phone']} | {r['tariff_name']} | {who}")
+    if not rows: lines.append("Пусто")
 
-    kb = InlineKeyboardBuilder().button(text="🔙 Назад", callback_data="admin_main")
+    kb = InlineKeyboardBuilder()
+    sizes = [len(QUEUE_VIEWS)]
+    for key, (_, t) in QUEUE_VIEWS.items():
+        kb.button(text=("• " if key == st else "") + t, callback_data=queue_cb(key, ti, wid, ">0"))
+    options = [("-", "Все")] + [(str(i), n) for i, n in enumerate(names)]
+    for key, n in options:
+        kb.button(text=("• " if key == ti else "") + n, callback_data=queue_cb(st, key, wid, ">0"))
+    sizes += [3] * (len(options) // 3) + ([len(options) % 3] if len(options) % 3 else [])
+    if status != 'queue':
+        workers = [wid] if wid else list(dict.fromkeys(r['worker_id'] for r in rows if r['worker_id']))[:3]
+        for w in workers:
+            kb.button(text=f"✖️ Воркер {w}" if wid else f"👷 {w}", callback_data=queue_cb(st, ti, 0 if wid else w, ">0"))
+        if workers: sizes.append(len(workers))
+    nav = []
+    if has_prev: nav.append(("⬅️", f"<{rows[0]['id'] if rows else after + 1}"))
+    if has_next and rows: nav.append(("➡️", f">{rows[-1]['id']}"))
+    for text, cur in nav: kb.button(text=text, callback_data=queue_cb(st, ti, wid, cur))
+    if nav: sizes.append(len(nav))
+    kb.button(text="🔙 Назад", callback_data="admin_main")
+    kb.adjust(*sizes, 1)
+    return "\n".join(lines), kb.as_markup()
 
-    await c.message.edit_text(txt, reply_markup=kb.as_markup(), parse_mode="HTML")
+@router.callback_query(F.data == "all_queue")
+async def cb_all_queue(c: CallbackQuery):
+    if c.from_user.id != ADMIN_ID: return
+    txt, kb = await queue_page()
+    await c.message.edit_text(txt, reply_markup=kb, parse_mode="HTML")
+    await c.answer()
+
+@router.callback_query(F.data.startswith("aq:"))
+async def cb_queue_page(c: CallbackQuery):
+    if c.from_user.id != ADMIN_ID: return
+    _, st, ti, wid, cursor = c.data.split(":")
+    txt, kb = await queue_page(st, ti, int(wid), cursor)
+    # Та же страница повторно — Telegram отвечает "message is not modified"
+    try: await c.message.edit_text(txt, reply_markup=kb, parse_mode="HTML")
+    except: pass
     await c.answer()
 
 @router.callback_query(F.data == "manage_groups")
 async def cb_mgr(c: CallbackQuery):
     if c.from_user.id != ADMIN_ID: return
-    async with get_db() as db:
+    async with get_db(readonly=True) as db:
         groups = await (await db.execute("SELECT * FROM groups ORDER BY group_num")).fetchall()
 
     kb = InlineKeyboardBuilder()
@@ -701,77 +2158,102 @@ async def cb_mgr(c: CallbackQuery):
     )
     await c.answer()
 
+def group_stop_text(job, done=False):
+    head = f"🛑 <b>Группа {job['gn']} остановлена</b>" if done else f"⏳ <b>Остановка группы {job['gn']}...</b>"
+    return (
+        f"{head}\n{SEP}\n"
+        f"🏢 {job['title']}\n"
+        f"⏰ {format_time(job['time'])}\n"
+        f"📦 Остановлено: {job['stopped']}\n"
+        f"📨 Уведомлено: {job['sent']}/{job['users']}" + (f" (❌ {job['failed']})" if job['failed'] else "")
+    )
+
+async def notify_group_stop(msg, job, nums):
+    # Фаза 2: одно сообщение на юзера (по GROUP_STOP_LINES номеров), отправка и лимиты — в outbox
+    by_user = defaultdict(list)
+    for n in nums: by_user[n['user_id']].append(n)
+    futs = []
+    for uid, own in by_user.items():
+        parts = []
+        for i in range(0, len(own), GROUP_STOP_LINES):
+            lines = "\n".join(
+                f"📱 {mask_phone(n['phone'], uid)} — ⏱ {calc_duration(n['start_time'], job['time'])}"
+                for n in own[i:i + GROUP_STOP_LINES]
+            )
+            parts.append(outbox.send(
+                uid,
+                f"🛑 <b>{job['title']} остановлен</b>\n{SEP}\n⏰ {format_time(job['time'])}\n\n{lines}",
+                parse_mode="HTML"
+            ))
+        futs.append(asyncio.gather(*parts))
+
+    shown = time.monotonic()
+    for fut in asyncio.as_completed(futs):
+        try:
+            await fut
+            job['sent'] += 1
+        except Exception:
+            job['failed'] += 1
+        if time.monotonic() - shown >= BROADCAST_PROGRESS_SECONDS:
+            shown = time.monotonic()
+            try: await msg.edit_text(group_stop_text(job), parse_mode="HTML")
+            except: pass
+
+    try: await msg.edit_text(group_stop_text(job, done=True), parse_mode="HTML")
+    except: pass
+
 @router.callback_query(F.data.startswith("stop_group_"))
 async def cb_stop_g(c: CallbackQuery, bot: Bot):
     if c.from_user.id != ADMIN_ID: return
     gn = int(c.data.split("_")[-1])
     stop_time = get_now()
+    src, dst = TRANSITIONS["stop"]
+    status = dst.format(gn=gn)
 
-    async with get_db() as db:
+    # Фаза 1: номера закрываются set-based UPDATE ... RETURNING (по одному на прежний статус — он нужен счетчикам);
+    # транзакция закрыта до первой отправки
+    async with get_db(readonly=True) as db:
         g = await (await db.execute("SELECT * FROM groups WHERE group_num=?", (gn,))).fetchone()
-        
-        if not g:
-            return await c.answer(f"❌ Группа {gn} не привязана!", show_alert=True)
-        
-        cid, title = g['chat_id'], g['title']
-        
-        nums = await (await db.execute("""
-            SELECT id, user_id, phone, start_time 
-            FROM numbers 
-            WHERE status IN ('work','active') AND worker_chat_id=?
-        """, (cid,))).fetchall()
-        
-        stopped = 0
-        for num in nums:
-            await db.execute(
-                "UPDATE numbers SET status=?, end_time=? WHERE id=?",
-                (f"finished_group_{gn}", stop_time, num['id'])
-            )
-            stopped += 1
-            
-            duration = calc_duration(num['start_time'], stop_time)
-            try:
-                await bot.send_message(
-                    num['user_id'],
-                    f"🛑 <b>{title} остановлен</b>\n{SEP}\n"
-                    f"📱 {mask_phone(num['phone'], num['user_id'])}\n"
-                    f"⏰ {format_time(stop_time)}\n"
-                    f"⏱ Работа: {duration}",
-                    parse_mode="HTML"
-                )
-            except: pass
+    if not g:
+        return await c.answer(f"❌ Группа {gn} не привязана!", show_alert=True)
+    cid, title = g['chat_id'], g['title']
+
+    async with get_db() as db:
+        nums = []
+        for old in src:
+            rows = await (await db.execute("""
+                UPDATE numbers SET status=?, end_time=?, version=version+1
+                WHERE status=? AND worker_chat_id=?
+                RETURNING id, user_id, phone, tariff_name, start_time
+            """, (status, stop_time, old, cid))).fetchall()
+            for (uid, tariff), n in Counter((r['user_id'], r['tariff_name']) for r in rows).items():
+                await stats.move(db, uid, tariff, old, status, cid, n=n)
+            nums += rows
         
         await db.commit()
-
-    await c.message.edit_text(
-        f"🛑 <b>Группа {gn} остановлена</b>\n{SEP}\n"
-        f"🏢 {title}\n"
-        f"⏰ {format_time(stop_time)}\n"
-        f"📦 Остановлено: {stopped}",
-        parse_mode="HTML"
-    )
+        for num in nums:
+            routes.remove(num['id'])
+            timers.cancel("code", num['id'])
+    await routes.publish(*(num['id'] for num in nums))
+
+    job = {
+        'gn': gn, 'title': title, 'time': stop_time, 'stopped': len(nums),
+        'users': len({num['user_id'] for num in nums}), 'sent': 0, 'failed': 0
+    }
+    await c.message.edit_text(group_stop_text(job, done=not nums), parse_mode="HTML")
     await c.answer()
+    if nums: asyncio.create_task(notify_group_stop(c.message, job, nums))
 
 @router.callback_query(F.data == "groups_status")
 async def cb_g_stat(c: CallbackQuery):
-    async with get_db() as db:
-        stats = {}
-        for i in range(1, 4):
-            stats[f"Группа {i}"] = (await (await db.execute(
-                "SELECT COUNT(*) FROM numbers WHERE status=?", 
-                (f"finished_group_{i}",)
-            )).fetchone())[0]
-
-        active = (await (await db.execute(
-            "SELECT COUNT(*) FROM numbers WHERE status IN ('work','active')"
-        )).fetchone())[0]
-        
-        queue = (await (await db.execute(
-            "SELECT COUNT(*) FROM numbers WHERE status='queue'"
-        )).fetchone())[0]
+    async with get_db(readonly=True) as db:
+        counts = await stats.by_status(db)
+    finished = {f"Группа {i}": counts[f"finished_group_{i}"] for i in range(1, 4)}
+    active = counts['work'] + counts['active']
+    queue = counts['queue']
 
     txt = f"📊 <b>СТАТУС</b>\n{SEP}\n"
-    for g, cnt in stats.items():
+    for g, cnt in finished.items():
         txt += f"🏁 {g}: {cnt}\n"
     txt += f"\n🔥 Активно: {active}\n🟡 Очередь: {queue}"
 
@@ -783,16 +2265,7 @@ async def cb_g_stat(c: CallbackQuery):
 @router.callback_query(F.data == "adm_tariffs")
 async def cb_adm_t(c: CallbackQuery):
     if c.from_user.id != ADMIN_ID: return
-    async with get_db() as db:
-        ts = await (await db.execute("SELECT * FROM tariffs")).fetchall()
-
-    kb = InlineKeyboardBuilder()
-    for t in ts:
-        kb.button(text=f"✏️ {t['name']}", callback_data=f"ed_{t['name']}")
-    kb.button(text="🔙 Назад", callback_data="admin_main")
-    kb.adjust(1)
-
-    await c.message.edit_text("🛠 <b>Выберите тариф:</b>", reply_markup=kb.as_markup(), parse_mode="HTML")
+    await c.message.edit_text("🛠 <b>Выберите тариф:</b>", reply_markup=config.keyboards["edit"], parse_mode="HTML")
     await c.answer()
 
 @router.callback_query(F.data.startswith("ed_"))
@@ -813,7 +2286,8 @@ async def cb_adm_r(c: CallbackQuery, state: FSMContext):
     await state.set_state(AdminState.report_hours)
 
     await c.message.edit_text(
-        "📊 Введите количество часов для отчета (до 120):"
+        "📊 Введите количество часов для отчета (до 120):\n"
+        "Добавьте «+» (например, 24+), чтобы получить сводку по тарифам и воркерам"
     )
     await c.answer()
 
@@ -834,31 +2308,264 @@ async def cb_helpreply(c: CallbackQuery, state: FSMContext):
     await c.message.answer(f"✍️ Введите ответ для {uid}:")
     await c.answer()
 
+# ==========================================
+# ИМПОРТ НОМЕРОВ
+# ==========================================
+
+PHONE_SEPARATORS = re.compile(r'[;,\t\n]')
+HAS_DIGIT = re.compile(r'\d')
+SMS_CAPTION = re.compile(r'/sms\s+([+\d]+)\s*(.*)', re.DOTALL)
+
+async def iter_text_tokens(text):
+    for tok in PHONE_SEPARATORS.split(text):
+        yield tok
+
+async def iter_document_tokens(bot, document):
+    # Файл читается потоком по 64 КБ, без загрузки целиком в память
+    file = await bot.get_file(document.file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in bot.session.stream_content(url=url, chunk_size=65536, raise_for_status=True):
+        parts = PHONE_SEPARATORS.split(tail + decoder.decode(chunk))
+        tail = parts.pop()
+        for tok in parts:
+            yield tok
+    yield tail + decoder.decode(b"", final=True)
+
+async def collect_phones(tokens):
+    # Токены копятся пачками и нормализуются разом; повторы внутри пачки отсекаются сразу
+    phones, seen, batch, dup, invalid = [], set(), [], 0, 0
+
+    def flush():
+        nonlocal dup, invalid
+        for ph in normalize_many(batch):
+            if not ph: invalid += 1
+            elif ph in seen: dup += 1
+            else:
+                seen.add(ph)
+                phones.append(ph)
+        batch.clear()
+
+    async for tok in tokens:
+        # Ячейки без цифр (заголовки, имена в CSV) номерами и не были — в невалидные не считаем
+        if not HAS_DIGIT.search(tok): continue
+        batch.append(tok)
+        if len(batch) >= IMPORT_CHUNK: flush()
+    flush()
+    return phones, dup, invalid
+
+async def import_numbers(uid, tariff, price, work_time, phones):
+    # Повторы с уже живыми номерами отбрасывает уникальный частичный индекс (INSERT OR IGNORE)
+    async with get_db() as db:
+        last_id = (await (await db.execute("SELECT COALESCE(MAX(id), 0) FROM numbers")).fetchone())[0]
+        before = db.total_changes
+        for i in range(0, len(phones), IMPORT_CHUNK):
+            await db.executemany(
+                "INSERT OR IGNORE INTO numbers (user_id, phone, tariff_name, tariff_price, work_time) VALUES (?, ?, ?, ?, ?)",
+                [(uid, ph, tariff, price, work_time) for ph in phones[i:i + IMPORT_CHUNK]]
+            )
+        accepted = db.total_changes - before
+        if accepted:
+            await db.execute("UPDATE users SET last_afk_check=?, afk_pending_since=NULL WHERE user_id=?", (get_now(), uid))
+            await stats.move(db, uid, tariff, None, 'queue', n=accepted)
+        await db.commit()
+
+        if accepted:
+            rows = await (await db.execute(
+                "SELECT id, user_id, phone, tariff_name, tariff_price FROM numbers WHERE id>? AND user_id=? AND status='queue'",
+                (last_id, uid)
+            )).fetchall()
+            for r in rows: qindex.add(QueueItem(*r))
+    if accepted: afk_arm(get_now(), None)
+    return accepted
+
+# ==========================================
+# АРХИВ
+# ==========================================
+
+class Archive:
+    # Завершенные номера уезжают из numbers в archive.numbers_ГГГГ_ММ (месяц по created_at).
+    # Копия и удаление — две транзакции, каждая в своей базе: после сбоя между ними строка
+    # окажется в обеих частях, но не потеряется; следующий проход удалит ее из numbers
+    async def tables(self, db, since=None):
+        # Части истории: numbers и помесячные архивы; с since — только месяцы не раньше него
+        parts = ["main.numbers"]
+        if not ARCHIVE_DB: return parts
+        first = time.strftime("numbers_%Y_%m", time.gmtime(since // 1000)) if since else ""
+        for r in await (await db.execute(
+            "SELECT name FROM archive.sqlite_master WHERE type='table' AND name GLOB 'numbers_[0-9]*' ORDER BY name DESC"
+        )).fetchall():
+            if r['name'] >= first: parts.append(f"archive.{r['name']}")
+        return parts
+
+    async def union(self, db, select, params=(), since=None):
+        # select с {t} вместо таблицы повторяется для каждой части через UNION ALL
+        parts = await self.tables(db, since)
+        return " UNION ALL ".join(select.format(t=t) for t in parts), tuple(params) * len(parts)
+
+    async def _partition(self, db, month):
+        # Колонки берутся из numbers: новые колонки после миграций доезжают до старых месяцев при следующей записи
+        name = f"numbers_{month}"
+        cols = await (await db.execute("PRAGMA main.table_info(numbers)")).fetchall()
+        have = {r['name'] for r in await (await db.execute(f"PRAGMA archive.table_info({name})")).fetchall()}
+        if not have:
+            defs = ", ".join(f"{c['name']} {c['type']}" + (" PRIMARY KEY" if c['pk'] else "") for c in cols)
+            await db.execute(f"CREATE TABLE archive.{name} ({defs})")
+            await db.execute(f"CREATE INDEX archive.idx_{name}_created ON {name}(created_at)")
+        for c in cols:
+            if have and c['name'] not in have:
+                await db.execute(f"ALTER TABLE archive.{name} ADD COLUMN {c['name']} {c['type']}")
+        return f"archive.{name}", ", ".join(c['name'] for c in cols)
+
+    async def run_once(self, days=ARCHIVE_AFTER_DAYS):
+        # Пачками по ARCHIVE_BATCH; между пачками писатель свободен для хендлеров
+        cut = get_now() - days * 86400000
+        moved = 0
+        while True:
+            async with get_db() as db:
+                rows = await (await db.execute("""
+                    SELECT id, strftime('%Y_%m', created_at / 1000, 'unixepoch') FROM numbers INDEXED BY idx_numbers_created
+                    WHERE created_at < ? AND status NOT IN ('queue','work','active') AND end_time < ?
+                    ORDER BY created_at LIMIT ?
+                """, (cut, cut, ARCHIVE_BATCH))).fetchall()
+                if not rows: return moved
+
+                by_month = defaultdict(list)
+                for nid, month in rows: by_month[month].append(nid)
+                for month, ids in by_month.items():
+                    table, cols = await self._partition(db, month)
+                    await db.execute(
+                        f"INSERT OR IGNORE INTO {table} ({cols}) SELECT {cols} FROM main.numbers WHERE id IN ({','.join('?' * len(ids))})", ids
+                    )
+                await db.commit()
+
+                ids = [r[0] for r in rows]
+                await db.execute(f"DELETE FROM main.numbers WHERE id IN ({','.join('?' * len(ids))})", ids)
+                await db.commit()
+            moved += len(rows)
+            await asyncio.sleep(0)
+
+archive = Archive()
+
+async def archive_loop():
+    if not ARCHIVE_DB or not ARCHIVE_AFTER_DAYS: return
+    while True:
+        try:
+            # При нескольких процессах архивирует один
+            async with shared.lease("archive") as owned:
+                if owned:
+                    t0 = time.perf_counter()
+                    moved = await archive.run_once()
+                    if moved: logger.info(f"🗃 Archived {moved} numbers in {time.perf_counter() - t0:.1f}s")
+        except Exception as e:
+            logger.exception(f"Archive error: {e}")
+        await asyncio.sleep(ARCHIVE_INTERVAL_MINUTES * 60)
+
+# ==========================================
+# ОТЧЕТЫ
+# ==========================================
+
+REPORT_STATUSES = ('queue', 'work', 'active', 'finished', 'dead')
+
+class SpooledInputFile(InputFile):
+    # Отдает готовый спул кусками — без второй копии отчета в памяти
+    def __init__(self, spool, filename, chunk_size=65536):
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.spool = spool
+
+    async def read(self, bot):
+        self.spool.seek(0)
+        while chunk := self.spool.read(self.chunk_size):
+            yield chunk
+
+async def build_report(hours, summary=False):
+    # Курсор читается пачками, CSV сразу жмется в gzip; до REPORT_SPOOL_BYTES спул живет в памяти, дальше — на диске
+    cut_time = get_now() - hours * 3600000
+    spool = tempfile.SpooledTemporaryFile(max_size=REPORT_SPOOL_BYTES)
+    rows = 0
+    by_tariff = defaultdict(Counter)
+    by_worker = defaultdict(Counter)
+
+    with gzip.GzipFile(fileobj=spool, mode="wb", compresslevel=6) as gz:
+        text = io.TextIOWrapper(gz, encoding="utf-8-sig", newline="")
+        w = csv.writer(text)
+        w.writerow(['ID', 'UserID', 'Phone', 'Status', 'Tariff', 'Created', 'Start', 'End', 'Duration'])
+
+        async with get_db(readonly=True) as db:
+            sql, params = await archive.union(db, """
+                SELECT id, user_id, phone, status, tariff_name, worker_id, created_at, start_time, end_time
+                FROM {t} WHERE created_at >= ?
+            """, (cut_time,), since=cut_time)
+            cur = await db.execute(sql + " ORDER BY created_at DESC, id DESC", params)
+            while chunk := await cur.fetchmany(REPORT_CHUNK):
+                for r in chunk:
+                    mins = duration_minutes(r['start_time'], r['end_time'])
+                    w.writerow([
+                        r['id'], r['user_id'], r['phone'], r['status'],
+                        r['tariff_name'], format_time(r['created_at']),
+                        format_time(r['start_time']), format_time(r['end_time']), f"{mins} мин"
+                    ])
+                    if summary:
+                        by_tariff[r['tariff_name']][r['status']] += 1
+                        if r['worker_id']:
+                            wk = by_worker[r['worker_id']]
+                            wk['taken'] += 1
+                            wk[r['status']] += 1
+                            if r['status'] in ('finished', 'dead'): wk['minutes'] += mins
+                rows += len(chunk)
+
+        if summary and rows:
+            w.writerow([])
+            w.writerow(['Tariff', 'Total', *(st.capitalize() for st in REPORT_STATUSES)])
+            for name, cnt in sorted(by_tariff.items()):
+                w.writerow([name, sum(cnt.values()), *(cnt[st] for st in REPORT_STATUSES)])
+            w.writerow([])
+            w.writerow(['WorkerID', 'Taken', 'Finished', 'Dead', 'Minutes', 'AvgMinutes'])
+            for wid, cnt in sorted(by_worker.items(), key=lambda kv: -kv[1]['taken']):
+                done = cnt['finished'] + cnt['dead']
+                w.writerow([wid, cnt['taken'], cnt['finished'], cnt['dead'], cnt['minutes'], cnt['minutes'] // done if done else 0])
+        text.flush()
+        text.detach()
+
+    if not rows:
+        spool.close()
+        return None, 0
+    return spool, rows
+
 # ==========================================
 # FSM HANDLERS
 # ==========================================
 
 @router.message(UserState.waiting_numbers)
-async def fsm_nums(m: Message, state: FSMContext):
+async def fsm_nums(m: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
-    raw = re.split(r'[;,\n]', m.text)
-    valid = [clean_phone(x.strip()) for x in raw if clean_phone(x.strip())]
 
-    if not valid:
+    if m.document:
+        name = (m.document.file_name or "").lower()
+        if not name.endswith((".txt", ".csv")):
+            return await m.reply("❌ Поддерживаются только файлы .txt и .csv")
+        if (m.document.file_size or 0) > IMPORT_MAX_BYTES:
+            return await m.reply("❌ Файл больше 20 МБ")
+        tokens = iter_document_tokens(bot, m.document)
+    elif m.text:
+        tokens = iter_text_tokens(m.text)
+    else:
+        return await m.reply("❌ Пришлите номера текстом или файлом")
+
+    phones, dup, invalid = await collect_phones(tokens)
+    if not phones and not dup:
         return await m.reply("❌ Не найдено валидных номеров")
 
-    async with get_db() as db:
-        for ph in valid:
-            await db.execute(
-                "INSERT INTO numbers (user_id, phone, tariff_name, tariff_price, work_time) VALUES (?, ?, ?, ?, ?)",
-                (m.from_user.id, ph, data['tariff'], data['price'], data.get('work_time', ''))
-            )
-        await db.execute("UPDATE users SET last_afk_check=? WHERE user_id=?", (get_now(), m.from_user.id))
-        await db.commit()
+    accepted = await import_numbers(m.from_user.id, data['tariff'], data['price'], data.get('work_time', ''), phones)
+    dup += len(phones) - accepted
 
     await state.clear()
     await m.answer(
-        f"✅ Принято: {len(valid)} шт\n{SEP}\nДобавлено в очередь",
+        f"✅ Принято: {accepted} шт\n{SEP}\n"
+        f"🔁 Дубликаты: {dup}\n"
+        f"❌ Невалидные: {invalid}\n"
+        f"Добавлено в очередь",
         reply_markup=main_kb(m.from_user.id)
     )
 
@@ -870,37 +2577,32 @@ async def fsm_help(m: Message, state: FSMContext, bot: Bot):
         callback_data=f"helpreply_{m.from_user.id}"
     )
 
-    try:
-        await bot.send_message(
-            ADMIN_ID,
-            f"🆘 <b>Новый запрос</b>\n{SEP}\n"
-            f"От: {m.from_user.id} (@{m.from_user.username})\n\n"
-            f"{m.text}",
-            reply_markup=kb.as_markup(),
-            parse_mode="HTML"
-        )
-        await m.answer(
-            "✅ Запрос отправлен\nОтвет будет направлен вам",
-            reply_markup=main_kb(m.from_user.id)
-        )
-    except Exception as e:
-        logger.error(f"Help error: {e}")
-        await m.answer("❌ Ошибка отправки")
+    outbox.send(
+        ADMIN_ID,
+        f"🆘 <b>Новый запрос</b>\n{SEP}\n"
+        f"От: {m.from_user.id} (@{m.from_user.username})\n\n"
+        f"{m.text}",
+        reply_markup=kb.as_markup(),
+        parse_mode="HTML",
+        on_fail=lambda: m.answer("❌ Ошибка отправки")
+    )
+    await m.answer(
+        "✅ Запрос отправлен\nОтвет будет направлен вам",
+        reply_markup=main_kb(m.from_user.id)
+    )
 
 @router.message(AdminState.help_reply)
 async def fsm_helpreply(m: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     await state.clear()
 
-    try:
-        await bot.send_message(
-            data['help_uid'],
-            f"👨‍💻 <b>Ответ на ваш запрос:</b>\n{SEP}\n{m.text}",
-            parse_mode="HTML"
-        )
-        await m.answer("✅ Ответ отправлен")
-    except:
-        await m.answer("❌ Не доставлено")
+    outbox.send(
+        data['help_uid'],
+        f"👨‍💻 <b>Ответ на ваш запрос:</b>\n{SEP}\n{m.text}",
+        parse_mode="HTML",
+        on_fail=lambda: m.answer("❌ Не доставлено")
+    )
+    await m.answer("✅ Ответ отправлен")
 
 @router.message(AdminState.waiting_broadcast)
 async def fsm_cast(m: Message, state: FSMContext, bot: Bot):
@@ -908,28 +2610,16 @@ async def fsm_cast(m: Message, state: FSMContext, bot: Bot):
     msg = await m.answer("⏳ Рассылка...")
 
     async with get_db() as db:
-        users = await (await db.execute(
-            "SELECT user_id FROM users WHERE is_approved=1"
-        )).fetchall()
+        total = (await (await db.execute(
+            "SELECT COUNT(*) FROM users WHERE is_approved=1 AND is_blocked=0"
+        )).fetchone())[0]
+        cur = await db.execute("""
+            INSERT INTO broadcasts (from_chat_id, message_id, status_chat_id, status_message_id, total)
+            VALUES (?, ?, ?, ?, ?)
+        """, (m.chat.id, m.message_id, msg.chat.id, msg.message_id, total))
+        await db.commit()
 
-    success, fail = 0, 0
-    for u in users:
-        try:
-            await m.copy_to(u['user_id'])
-            success += 1
-            await asyncio.sleep(0.05)
-        except TelegramForbiddenError:
-            fail += 1
-        except:
-            fail += 1
-
-    await msg.edit_text(
-        f"📢 <b>Рассылка завершена</b>\n{SEP}\n"
-        f"✅ Доставлено: {success}\n"
-        f"❌ Ошибок: {fail}\n"
-        f"📊 Всего: {len(users)}",
-        parse_mode="HTML"
-    )
+    asyncio.create_task(run_broadcast(bot, cur.lastrowid))
 
 @router.message(AdminState.edit_price)
 async def fsm_ep(m: Message, state: FSMContext):
@@ -940,12 +2630,7 @@ async def fsm_ep(m: Message, state: FSMContext):
 @router.message(AdminState.edit_time)
 async def fsm_et(m: Message, state: FSMContext):
     data = await state.get_data()
-    async with get_db() as db:
-        await db.execute(
-            "UPDATE tariffs SET price=?, work_time=? WHERE name=?",
-            (data['price'], m.text, data['target'])
-        )
-        await db.commit()
+    await config.update_tariff(data['target'], data['price'], m.text)
 
     await state.clear()
     await m.answer(
@@ -958,42 +2643,27 @@ async def fsm_et(m: Message, state: FSMContext):
 @router.message(AdminState.report_hours)
 async def fsm_rep(m: Message, state: FSMContext):
     await state.clear()
+    # "24+" — отчет со сводкой по тарифам и воркерам
+    raw = (m.text or "").strip()
+    summary = raw.endswith("+")
     try:
-        hours = int(m.text)
+        hours = int(raw.rstrip("+"))
         if hours < 1 or hours > 120:
             return await m.answer("❌ Введите число от 1 до 120")
     except:
         return await m.answer("❌ Введите корректное число")
 
-    cut_time = (datetime.now(timezone.utc) - timedelta(hours=hours)).isoformat()
-
-    async with get_db() as db:
-        rows = await (await db.execute("""
-            SELECT * FROM numbers 
-            WHERE created_at >= ? 
-            ORDER BY id DESC
-        """, (cut_time,))).fetchall()
-
-    if not rows:
+    spool, rows = await build_report(hours, summary)
+    if not spool:
         return await m.answer("📂 Пусто")
 
-    out = io.StringIO()
-    w = csv.writer(out)
-    w.writerow(['ID', 'UserID', 'Phone', 'Status', 'Tariff', 'Created', 'Start', 'End', 'Duration'])
-
-    for r in rows:
-        duration = calc_duration(r['start_time'], r['end_time'])
-        w.writerow([
-            r['id'], r['user_id'], r['phone'], r['status'],
-            r['tariff_name'], format_time(r['created_at']),
-            format_time(r['start_time']), format_time(r['end_time']), duration
-        ])
-
-    out.seek(0)
-    await m.answer_document(
-        BufferedInputFile(out.getvalue().encode(), filename=f"report_{hours}h.csv"),
-        caption=f"📊 Отчет за {hours}ч"
-    )
+    try:
+        await m.answer_document(
+            SpooledInputFile(spool, filename=f"report_{hours}h.csv.gz"),
+            caption=f"📊 Отчет за {hours}ч — {rows} строк" + (" + сводка" if summary else "")
+        )
+    finally:
+        spool.close()
 
 # ==========================================
 # РАБОТА С ФОТО И СООБЩЕНИЯМИ
@@ -1003,32 +2673,27 @@ async def fsm_rep(m: Message, state: FSMContext):
 async def handle_photo(m: Message, bot: Bot):
     # Обработка фото от воркера
     if m.chat.type != "private":
-        match = re.search(r'/sms\s+([+\d]+)\s*(.*)', m.caption, flags=re.DOTALL)
+        match = SMS_CAPTION.search(m.caption)
         if match:
             ph = clean_phone(match.group(1))
             text_for_user = match.group(2).strip() or "Вам сообщение от офиса"
             
             if not ph: return await m.reply("❌ Неверный номер")
             
-            async with get_db() as db:
-                row = await (await db.execute(
-                    "SELECT * FROM numbers WHERE phone=? AND status IN ('work','active')",
-                    (ph,)
-                )).fetchone()
-            
+            row = routes.phone(ph)
             if not row: return await m.reply("❌ Номер не в работе")
-            if row['worker_id'] != m.from_user.id: return await m.reply("🚫 Не ваш номер")
+            if row.worker_id != m.from_user.id: return await m.reply("🚫 Не ваш номер")
             
-            try:
-                await bot.send_photo(
-                    chat_id=row['user_id'],
-                    photo=m.photo[-1].file_id,
-                    caption=f"📩 <b>Сообщение от офиса:</b>\n{SEP}\n{text_for_user}",
-                    parse_mode="HTML"
-                )
-                await m.react([ReactionTypeEmoji(emoji="👌")])
-            except Exception as e:
-                await m.reply(f"❌ Не доставлено: {e}")
+            outbox.send(
+                row.user_id,
+                method="send_photo",
+                prio=PRIO_BRIDGE,
+                photo=m.photo[-1].file_id,
+                caption=f"📩 <b>Сообщение от офиса:</b>\n{SEP}\n{text_for_user}",
+                parse_mode="HTML",
+                on_ok=lambda: m.react([ReactionTypeEmoji(emoji="👌")]),
+                on_fail=lambda: m.reply("❌ Не доставлено")
+            )
 
 # ==========================================
 # ГЛАВНЫЙ ОБРАБОТЧИК СООБЩЕНИЙ (ПОСЛЕДНИЙ!)
@@ -1046,153 +2711,544 @@ async def handle_msg(m: Message, bot: Bot, state: FSMContext):
     cs = await state.get_state()
     if cs: return
 
-    # Ищем активный номер юзера
-    async with get_db() as db:
-        row = await (await db.execute(
-            "SELECT * FROM numbers WHERE user_id=? AND status IN ('work','active')",
-            (m.from_user.id,)
-        )).fetchone()
+    # Ищем активный номер юзера; ответ на сообщение бота указывает, о каком номере речь
+    reply = m.reply_to_message
+    row = routes.pick(m.from_user.id, reply and (reply.text or reply.caption))
 
-    if row and row['worker_chat_id']:
+    if row and row.worker_chat_id:
         # Сбрасываем таймер кода если был запрос
-        if row['wait_code_start']:
-            async with get_db() as db:
-                await db.execute("UPDATE numbers SET wait_code_start=NULL WHERE id=?", (row['id'],))
-                await db.commit()
+        if row.wait_code_start:
+            routes.set_wait(row.id, None)
+            await writes.put("code_wait", row.id, None, then=lambda: routes.publish(row.id))
+            timers.cancel("code", row.id)
         
         # Отправляем в топик воркера
-        try:
-            tc = row['worker_chat_id']
-            tt = row['worker_thread_id'] if row['worker_thread_id'] else None
-            hdr = f"📩 <b>ОТВЕТ ЮЗЕРА</b>\n📱 {row['phone']}\n{SEP}\n"
-            
-            if m.text:
-                await bot.send_message(
-                    tc,
-                    message_thread_id=tt,
-                    text=f"{hdr}💬 {m.text}",
-                    parse_mode="HTML"
-                )
-            elif m.photo:
-                await bot.send_photo(
-                    tc,
-                    message_thread_id=tt,
-                    photo=m.photo[-1].file_id,
-                    caption=f"{hdr}📸",
-                    parse_mode="HTML"
-                )
-            
+        tc = row.worker_chat_id
+        tt = row.worker_thread_id or None
+        hdr = f"📩 <b>ОТВЕТ ЮЗЕРА</b>\n📱 {row.phone}\n{SEP}\n"
+
+        async def ack():
             await m.react([ReactionTypeEmoji(emoji="⚡")])
             await m.reply("✅ Сообщение передано в офис")
-        except Exception as e:
-            logger.error(f"Bridge error: {e}")
+
+        async def nack():
+            logger.error(f"Bridge error: {row.phone} -> {tc}")
             await m.reply("❌ Ошибка доставки")
 
+        if m.text:
+            outbox.send(
+                tc, f"{hdr}💬 {m.text}", prio=PRIO_BRIDGE,
+                message_thread_id=tt, parse_mode="HTML", on_ok=ack, on_fail=nack
+            )
+        elif m.photo:
+            outbox.send(
+                tc, method="send_photo", prio=PRIO_BRIDGE,
+                message_thread_id=tt, photo=m.photo[-1].file_id, caption=f"{hdr}📸",
+                parse_mode="HTML", on_ok=ack, on_fail=nack
+            )
+        else:
+            await ack()
+
+# ==========================================
+# РАССЫЛКА
+# ==========================================
+
+async def deliver_copy(bot, sem, uid, from_chat_id, message_id):
+    async with sem:
+        for _ in range(3):
+            await limiter.acquire(uid)
+            try:
+                await bot.copy_message(chat_id=uid, from_chat_id=from_chat_id, message_id=message_id)
+                return "sent"
+            except TelegramRetryAfter as e:
+                limiter.pause(e.retry_after)
+            except TelegramForbiddenError:
+                return "blocked"
+            except Exception as e:
+                logger.warning(f"Broadcast to {uid} failed: {e}")
+                return "failed"
+        return "failed"
+
+def broadcast_text(job, done=False):
+    head = "📢 <b>Рассылка завершена</b>" if done else "⏳ <b>Рассылка...</b>"
+    return (
+        f"{head}\n{SEP}\n"
+        f"✅ Доставлено: {job['sent']}\n"
+        f"❌ Ошибок: {job['failed']}\n"
+        f"🚫 Заблокировали бота: {job['blocked']}\n"
+        f"📊 Всего: {job['sent'] + job['failed'] + job['blocked']}/{job['total']}"
+    )
+
+async def run_broadcast(bot, job_id):
+    # При нескольких процессах рассылку ведет тот, кто взял аренду; остальные ее пропускают
+    async with shared.lease(f"broadcast:{job_id}") as owned:
+        if owned: await broadcast_loop(bot, job_id)
+
+async def broadcast_loop(bot, job_id):
+    # Прогресс сохраняется после каждой пачки: после рестарта рассылка продолжится с cursor
+    async with get_db(readonly=True) as db:
+        row = await (await db.execute("SELECT * FROM broadcasts WHERE id=?", (job_id,))).fetchone()
+    if not row or row['state'] != 'running': return
+    job = dict(row)
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    shown = 0.0
+    logger.info(f"📢 Broadcast {job_id} running from user {job['cursor']}")
+
+    while True:
+        async with get_db(readonly=True) as db:
+            users = [r[0] for r in await (await db.execute("""
+                SELECT user_id FROM users
+                WHERE is_approved=1 AND is_blocked=0 AND user_id>?
+                ORDER BY user_id LIMIT ?
+            """, (job['cursor'], BROADCAST_CHUNK))).fetchall()]
+        if not users: break
+
+        results = await asyncio.gather(*[
+            deliver_copy(bot, sem, uid, job['from_chat_id'], job['message_id']) for uid in users
+        ])
+        blocked = [(uid,) for uid, r in zip(users, results) if r == "blocked"]
+        for r in ("sent", "failed", "blocked"):
+            job[r] += results.count(r)
+        job['cursor'] = users[-1]
+
+        async with get_db() as db:
+            if blocked: await db.executemany("UPDATE users SET is_blocked=1 WHERE user_id=?", blocked)
+            await db.execute(
+                "UPDATE broadcasts SET cursor=?, sent=?, failed=?, blocked=? WHERE id=?",
+                (job['cursor'], job['sent'], job['failed'], job['blocked'], job_id)
+            )
+            await db.commit()
+
+        if time.monotonic() - shown >= BROADCAST_PROGRESS_SECONDS:
+            shown = time.monotonic()
+            try:
+                await bot.edit_message_text(
+                    broadcast_text(job), chat_id=job['status_chat_id'],
+                    message_id=job['status_message_id'], parse_mode="HTML"
+                )
+            except: pass
+
+    async with get_db() as db:
+        await db.execute("UPDATE broadcasts SET state='done', finished_at=CURRENT_TIMESTAMP WHERE id=?", (job_id,))
+        await db.commit()
+
+    logger.info(f"📢 Broadcast {job_id} done: {job['sent']} sent, {job['failed']} failed, {job['blocked']} blocked")
+    try:
+        await bot.edit_message_text(
+            broadcast_text(job, done=True), chat_id=job['status_chat_id'],
+            message_id=job['status_message_id'], parse_mode="HTML"
+        )
+    except: pass
+
+async def resume_broadcasts(bot):
+    async with get_db(readonly=True) as db:
+        jobs = await (await db.execute("SELECT id FROM broadcasts WHERE state='running'")).fetchall()
+    for j in jobs:
+        asyncio.create_task(run_broadcast(bot, j['id']))
+
 # ==========================================
 # МОНИТОРИНГ
 # ==========================================
 
+class DeadlineScheduler:
+    # Куча (срок, seq, ключ). Отмена и перевзвод ленивые: устаревшие записи в куче пропускаются.
+    # Пока ничего не взведено, цикл спит на Event и не делает никакой работы.
+    def __init__(self):
+        self.heap = []
+        self.deadlines = {}
+        self.handlers = {}
+        self.wake = asyncio.Event()
+        self.seq = 0
+
+    def on(self, kind, handler):
+        self.handlers[kind] = handler
+
+    def arm(self, kind, arg, when):
+        key = (kind, arg)
+        self.seq += 1
+        self.deadlines[key] = (when, self.seq)
+        heapq.heappush(self.heap, (when, self.seq, key))
+        if self.heap[0][1] == self.seq: self.wake.set()
+        if len(self.heap) > 2 * len(self.deadlines) + 1000:
+            self.heap = [(w, q, k) for k, (w, q) in self.deadlines.items()]
+            heapq.heapify(self.heap)
+
+    def arm_earliest(self, kind, arg, when):
+        # Взводит, только если срок раньше уже взведенного
+        cur = self.deadlines.get((kind, arg))
+        if not cur or when < cur[0]: self.arm(kind, arg, when)
+
+    def cancel(self, kind, arg):
+        self.deadlines.pop((kind, arg), None)
+
+    def armed(self, kind, arg):
+        return (kind, arg) in self.deadlines
+
+    async def _fire(self, kind, arg):
+        t0 = time.perf_counter()
+        try: await self.handlers[kind](arg)
+        except Exception as e: logger.exception(f"Timer {kind}:{arg} error: {e}")
+        metrics.observe("bot_timer_seconds", time.perf_counter() - t0, kind=kind)
+
+    async def run(self):
+        while True:
+            self.wake.clear()
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                when, seq, key = heapq.heappop(self.heap)
+                if self.deadlines.get(key) != (when, seq): continue
+                del self.deadlines[key]
+                asyncio.create_task(self._fire(*key))
+            if not self.heap:
+                await self.wake.wait()
+                continue
+            try: await asyncio.wait_for(self.wake.wait(), self.heap[0][0] - now)
+            except asyncio.TimeoutError: pass
+
+timers = DeadlineScheduler()
+
+async def drop_queues(db, uids):
+    if not uids: return
+    rows = await (await db.execute(
+        f"DELETE FROM numbers WHERE status='queue' AND user_id IN ({','.join('?' * len(uids))}) RETURNING user_id, tariff_name",
+        uids
+    )).fetchall()
+    for (uid, tariff), n in Counter((r[0], r[1]) for r in rows).items():
+        await stats.move(db, uid, tariff, 'queue', None, n=n)
+
+async def code_timeout(nid):
+    await writes.flush()
+    async with get_db() as db:
+        w = await (await db.execute("""
+            SELECT id, user_id, phone, status, version, tariff_name, worker_chat_id, worker_thread_id, wait_code_start
+            FROM numbers WHERE id=?
+        """, (nid,))).fetchone()
+        # Таймаут действует только на вставший номер; если номер еще в 'work', cb_w_act взведет его снова
+        if not w or w['status'] != 'active' or not w['wait_code_start']: return
+        due = w['wait_code_start'] / 1000 + CODE_WAIT_MINUTES * 60
+        if due > time.time(): return timers.arm("code", nid, due)
+
+        # Таймер мог сработать и в соседнем процессе, воркер мог успеть нажать «Слет» или запросить код заново:
+        # мертвым номер делает только первый, и только если ожидание кода то же самое
+        if not await transition(db, w, "timeout", guard=("wait_code_start",), end_time=get_now(), wait_code_start=None):
+            return
+        await db.commit()
+        routes.remove(w['id'])
+    await routes.publish(w['id'])
+
+    outbox.send(w['user_id'], f"⏰ Время истекло\n{w['phone']} отменен")
+    if w['worker_chat_id']:
+        outbox.send(
+            w['worker_chat_id'],
+            "⚠️ Таймаут кода!",
+            prio=PRIO_BRIDGE,
+            message_thread_id=w['worker_thread_id'] if w['worker_thread_id'] else None
+        )
+
+async def afk_sweep(batch=AFK_SWEEP_BATCH):
+    # Один проход: кого пинговать — одним запросом, пинги параллельно через outbox (лимиты там же),
+    # все изменения — одним коммитом. Кик решается внутри транзакции: «Я тут» до коммита его отменяет
+    await writes.flush()
+    now = get_now()
+    async with get_db(readonly=True) as db:
+        due = await (await db.execute("""
+            SELECT user_id, last_afk_check FROM users
+            WHERE afk_pending_since IS NULL AND (last_afk_check IS NULL OR last_afk_check < ?)
+              AND user_id IN (SELECT user_id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue')
+            LIMIT ?
+        """, (now - AFK_CHECK_MINUTES * 60000, batch))).fetchall()
+
+    results = await asyncio.gather(*[
+        outbox.send(
+            u['user_id'],
+            f"⚠️ <b>Проверка активности!</b>\n{SEP}\nНажмите кнопку",
+            reply_markup=afk_kb(u['user_id']),
+            parse_mode="HTML"
+        ) for u in due
+    ], return_exceptions=True)
+    pinged = [u for u, r in zip(due, results) if not isinstance(r, BaseException)]
+    blocked = [u['user_id'] for u, r in zip(due, results) if isinstance(r, TelegramForbiddenError)]
+
+    stamp = get_now()
+    async with get_db() as db:
+        # CAS по прочитанному last_afk_check: взятый номер или новая заявка во время пингов отменяют проверку
+        await db.executemany(
+            "UPDATE users SET afk_pending_since=? WHERE user_id=? AND afk_pending_since IS NULL AND last_afk_check IS ?",
+            [(stamp, u['user_id'], u['last_afk_check']) for u in pinged]
+        )
+        await db.executemany("UPDATE users SET is_blocked=1 WHERE user_id=?", [(uid,) for uid in blocked])
+        kicked = [r[0] for r in await (await db.execute("""
+            UPDATE users SET last_afk_check=?, afk_pending_since=NULL
+            WHERE afk_pending_since < ? AND user_id IN (SELECT user_id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue')
+            RETURNING user_id
+        """, (stamp, now - AFK_KICK_MINUTES * 60000))).fetchall()]
+        await drop_queues(db, blocked + kicked)
+        await db.commit()
+
+    for uid in blocked + kicked: qindex.remove_user(uid)
+    for uid in kicked: outbox.send(uid, "❌ Заявки удалены из-за неактивности")
+    return len(pinged), len(kicked), len(blocked)
+
+async def afk_next_due(db):
+    # Ближайший срок среди поставщиков с очередью: пинг через AFK_CHECK_MINUTES после отметки, кик через AFK_KICK_MINUTES после пинга
+    due = (await (await db.execute("""
+        SELECT MIN(CASE WHEN afk_pending_since IS NULL THEN COALESCE(last_afk_check, 0) + ? ELSE afk_pending_since + ? END)
+        FROM users WHERE user_id IN (SELECT user_id FROM numbers INDEXED BY idx_numbers_queue WHERE status='queue')
+    """, (AFK_CHECK_MINUTES * 60000, AFK_KICK_MINUTES * 60000))).fetchone())[0]
+    return afk_deadline(due) if due is not None else None
+
+def afk_deadline(due_ms):
+    # afk_sweep берет строго просроченных (< now - интервал): в ту же миллисекунду проход ничего бы не нашел
+    return (due_ms + 1) / 1000
+
+def afk_arm(last_afk_check, afk_pending_since):
+    # У поставщика снова есть очередь (загрузка, «Пропуск»): его срок может оказаться ближайшим
+    if afk_pending_since: due = afk_pending_since + AFK_KICK_MINUTES * 60000
+    else: due = (last_afk_check or 0) + AFK_CHECK_MINUTES * 60000
+    timers.arm_earliest("afk", 0, afk_deadline(due))
+
+async def afk_timer(_):
+    # Таймер "afk" взведен на ближайший срок; без очередей не взведен вовсе и ничего не опрашивает
+    started = time.time()
+    try:
+        # При нескольких процессах проход делает один, остальные перепроверят срок через AFK_SWEEP_SECONDS
+        async with shared.lease("afk") as owned:
+            if owned:
+                t0 = time.perf_counter()
+                pinged, kicked, blocked = await afk_sweep()
+                metrics.observe("bot_afk_sweep_seconds", time.perf_counter() - t0)
+                if pinged or kicked or blocked:
+                    logger.info(f"💤 AFK sweep: {pinged} pinged, {kicked} kicked, {blocked} blocked")
+    except Exception as e:
+        logger.exception(f"AFK sweep error: {e}")
+
+    due = started
+    try:
+        async with get_db(readonly=True) as db:
+            due = await afk_next_due(db)
+    except Exception as e:
+        logger.exception(f"AFK schedule error: {e}")
+    # Недоставленные пинги и хвост больше AFK_SWEEP_BATCH остаются просроченными — повтор не раньше AFK_SWEEP_SECONDS
+    if due is not None: timers.arm_earliest("afk", 0, max(due, started + AFK_SWEEP_SECONDS))
+
+async def rebuild_timers(db):
+    waiters = await (await db.execute("""
+        SELECT id, wait_code_start FROM numbers
+        WHERE status IN ('work','active') AND wait_code_start IS NOT NULL
+    """)).fetchall()
+    for w in waiters:
+        timers.arm("code", w['id'], w['wait_code_start'] / 1000 + CODE_WAIT_MINUTES * 60)
+    afk_due = await afk_next_due(db)
+    if afk_due is not None: timers.arm("afk", 0, afk_due)
+    logger.info(f"⏱ Timers rebuilt: {len(waiters)} code waits, AFK {'armed' if afk_due is not None else 'idle'}")
+
 async def monitor(bot: Bot):
     logger.info("👀 Monitor started (FINAL)")
-    while True:
-        await asyncio.sleep(60)
-        now = datetime.now(timezone.utc)
-        
-        try:
-            async with get_db() as db:
-                # 1. Таймаут кода
-                waiters = await (await db.execute("""
-                    SELECT id, user_id, phone, worker_chat_id, worker_thread_id, wait_code_start 
-                    FROM numbers 
-                    WHERE status='active' AND wait_code_start IS NOT NULL
-                """)).fetchall()
-                
-                for w in waiters:
-                    st = datetime.fromisoformat(w['wait_code_start'])
-                    if (now - st).total_seconds() / 60 >= CODE_WAIT_MINUTES:
-                        await db.execute(
-                            "UPDATE numbers SET status='dead', end_time=?, wait_code_start=NULL WHERE id=?",
-                            (get_now(), w['id'])
-                        )
-                        
-                        try:
-                            await bot.send_message(
-                                w['user_id'],
-                                f"⏰ Время истекло\n{w['phone']} отменен"
-                            )
-                            
-                            if w['worker_chat_id']:
-                                await bot.send_message(
-                                    chat_id=w['worker_chat_id'],
-                                    message_thread_id=w['worker_thread_id'] if w['worker_thread_id'] else None,
-                                    text="⚠️ Таймаут кода!"
-                                )
-                        except: pass
-                
-                # 2. AFK проверка
-                users = await (await db.execute("""
-                    SELECT DISTINCT u.user_id, u.last_afk_check 
-                    FROM users u 
-                    JOIN numbers n ON u.user_id = n.user_id 
-                    WHERE n.status = 'queue'
-                """)).fetchall()
-                
-                for u in users:
-                    uid = u['user_id']
-                    last = u['last_afk_check']
-                    
-                    if not last or (not str(last).startswith("PENDING") and (now - datetime.fromisoformat(last)).total_seconds() / 60 > AFK_CHECK_MINUTES):
-                        kb = InlineKeyboardMarkup(inline_keyboard=[[
-                            InlineKeyboardButton(text="👋 Я тут!", callback_data=f"afk_ok_{uid}")
-                        ]])
-                        try:
-                            await bot.send_message(
-                                uid,
-                                f"⚠️ <b>Проверка активности!</b>\n{SEP}\nНажмите кнопку",
-                                reply_markup=kb,
-                                parse_mode="HTML"
-                            )
-                            await db.execute("UPDATE users SET last_afk_check=? WHERE user_id=?", (f"PENDING_{get_now()}", uid))
-                        except TelegramForbiddenError:
-                            await db.execute("DELETE FROM numbers WHERE user_id=? AND status='queue'", (uid,))
-                        except: pass
-                    
-                    elif str(last).startswith("PENDING_"):
-                        pt = datetime.fromisoformat(last.split("_")[1])
-                        if (now - pt).total_seconds() / 60 > AFK_KICK_MINUTES:
-                            await db.execute("DELETE FROM numbers WHERE user_id=? AND status='queue'", (uid,))
-                            await db.execute("UPDATE users SET last_afk_check=? WHERE user_id=?", (get_now(), uid))
-                            try:
-                                await bot.send_message(uid, "❌ Заявки удалены из-за неактивности")
-                            except: pass
-                
-                await db.commit()
-                
-        except Exception as e:
-            logger.exception(f"Monitor Error: {e}")
-            await asyncio.sleep(5)
+    timers.on("code", code_timeout)
+    timers.on("afk", afk_timer)
+    async with get_db(readonly=True) as db:
+        await rebuild_timers(db)
+    await timers.run()
+
+# ==========================================
+# ВЕБХУК
+# ==========================================
+
+def update_chat_key(update):
+    # Ключ порядка: чат сообщения (для колбэков — чат кнопки), иначе автор, иначе сам апдейт
+    ev = update.event
+    chat = getattr(ev, "chat", None) or getattr(getattr(ev, "message", None), "chat", None)
+    if chat: return chat.id
+    user = getattr(ev, "from_user", None)
+    return user.id if user else update.update_id
+
+class UpdatePool:
+    # Апдейты одного чата всегда попадают в один шард и разбираются по очереди — мост не путает порядок.
+    # Шарды работают параллельно, очереди ограничены: при заполнении вебхук ждет, потом отвечает 503,
+    # и Telegram повторяет доставку сам — апдейт не теряется.
+    # 200 уходит только после обработки: апдейт, оставшийся в очереди при падении или остановке,
+    # Telegram считает недоставленным и пришлет снова
+    def __init__(self, dp, bot, workers, size):
+        self.dp = dp
+        self.bot = bot
+        self.queues = [asyncio.Queue(size) for _ in range(workers)]
+        self.tasks = []
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.errors = 0
+        self.put_wait_max = 0.0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._worker(q)) for q in self.queues]
+
+    async def stop(self, timeout=10):
+        # Новых апдейтов уже нет (сервер закрыт): дорабатываем очереди, потом гасим воркеров.
+        # Недоработанные апдейты без ответа — Telegram повторит их после рестарта
+        deadline = time.monotonic() + timeout
+        while any(q.qsize() for q in self.queues) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        for t in self.tasks: t.cancel()
+        for q in self.queues:
+            while not q.empty():
+                _, _, done = q.get_nowait()
+                if not done.done(): done.set_result(False)
+        logger.info(f"📥 Update pool stopped: {self.stats()}")
+
+    async def _worker(self, queue):
+        while True:
+            queued_at, update, done = await queue.get()
+            wait = time.monotonic() - queued_at
+            self.queue_wait_total += wait
+            self.queue_wait_max = max(self.queue_wait_max, wait)
+            try: await self.dp.feed_update(self.bot, update)
+            except asyncio.CancelledError:
+                if not done.done(): done.set_result(False)
+                raise
+            except Exception as e:
+                # Ошибка хендлера — тоже ответ: повтор того же апдейта упал бы так же
+                self.errors += 1
+                logger.exception(f"Update {update.update_id} error: {e}")
+            if not done.done(): done.set_result(True)
+            self.processed += 1
+            queue.task_done()
+
+    async def handle(self, request):
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try: update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except: return web.Response(status=400)
+
+        queue = self.queues[hash(update_chat_key(update)) % len(self.queues)]
+        t0 = time.monotonic()
+        done = asyncio.get_running_loop().create_future()
+        try: await asyncio.wait_for(queue.put((t0, update, done)), UPDATE_PUT_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.put_wait_max = max(self.put_wait_max, time.monotonic() - t0)
+        self.accepted += 1
+        if not await done: return web.Response(status=503)
+        return web.Response()
+
+    def stats(self):
+        depths = [q.qsize() for q in self.queues]
+        return {
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "errors": self.errors,
+            "depth": sum(depths),
+            "depth_max": max(depths),
+            "capacity": UPDATE_QUEUE,
+            "put_wait_max_ms": round(self.put_wait_max * 1000, 3),
+            "queue_wait_avg_ms": round(self.queue_wait_total / self.processed * 1000, 3) if self.processed else 0.0,
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 3),
+        }
+
+update_pool = None
+
+async def run_webhook(bot, dp):
+    global update_pool
+    update_pool = pool = UpdatePool(dp, bot, UPDATE_WORKERS, UPDATE_QUEUE)
+    metrics.gauge("bot_update_pool", "Webhook update pool backpressure",
+                  lambda: {(("field", k),): v for k, v in pool.stats().items()})
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, pool.handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    pool.start()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    # Без WEBHOOK_URL вебхук не регистрируем: он настроен снаружи или апдейты шлются руками (локальная проверка)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            drop_pending_updates=False
+        )
+    logger.info(f"🌐 Webhook listening on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}, {UPDATE_WORKERS} workers")
+
+    try: await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        await pool.stop()
 
 # ==========================================
 # ЗАПУСК
 # ==========================================
 
+def build_dispatcher(bot):
+    # Общая сборка для боевого запуска и loadtest.py
+    bot.session.middleware(api_metrics)
+    dp = Dispatcher(storage=shared.storage())
+    dp.update.outer_middleware(update_metrics)
+    router.message.outer_middleware(access_guard)
+    router.callback_query.outer_middleware(access_guard)
+    router.message.middleware(handler_name)
+    router.callback_query.middleware(handler_name)
+    dp.include_router(router)
+    register_gauges()
+    return dp
+
+async def load_state():
+    # Зеркала в памяти: тарифы и привязки, очередь, маршруты моста и счетчики статистики (счетчики заодно сверяются с numbers)
+    await config.load()
+    async with get_db(readonly=True) as db:
+        await qindex.load(db)
+        await routes.load(db)
+    async with get_db() as db:
+        await stats.reconcile(db)
+
+async def on_shared_change(kind):
+    # Лента изменений от соседних процессов: маршруты перечитываются по id, доступ сбрасывается по юзеру, остальное — кэш конфигурации
+    if kind.startswith("route:"):
+        return await routes.refresh([int(nid) for nid in kind[6:].split(",")])
+    if kind.startswith("access:"):
+        return access.invalidate(int(kind[7:]))
+    await config.on_change(kind)
+    if kind == "all":
+        access.items.clear()
+        async with get_db(readonly=True) as db:
+            await routes.load(db)
+
 async def main():
+    await db_pool.open()
     await init_db()
+    await load_state()
 
     bot = Bot(token=TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
-    dp.include_router(router)
-
-    await bot.delete_webhook(drop_pending_updates=True)
+    outbox.start(bot)
+    writes.start()
+    dp = build_dispatcher(bot)
+    metrics_runner = await start_metrics_server()
 
     asyncio.create_task(monitor(bot))
+    asyncio.create_task(qindex_watchdog())
+    asyncio.create_task(shared.listen(on_shared_change))
+    asyncio.create_task(archive_loop())
+    await resume_broadcasts(bot)
 
-    logger.info("🚀 BOT STARTED - FINAL MERGED VERSION")
+    logger.info(f"🚀 BOT STARTED - FINAL MERGED VERSION ({RUN_MODE}, {'redis' if REDIS_URL else 'local'} state)")
 
     try:
-        await dp.start_polling(bot)
+        if RUN_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Апдейты, пришедшие пока бот лежал, не выбрасываем
+            await bot.delete_webhook(drop_pending_updates=False)
+            await dp.start_polling(bot)
     finally:
+        await outbox.stop()
+        await writes.stop()
+        if metrics_runner: await metrics_runner.cleanup()
         await bot.session.close()
+        await shared.close()
+        await db_pool.close()
 
 if __name__ == "__main__":
     try: